@@ -0,0 +1,421 @@
+#!/usr/bin/python
+# benchmark.py - Measure the speed of pep8.py on reproducible corpora
+# Copyright (C) 2006 Johann C. Rocholl <johann@rocholl.net>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Measure the speed of pep8.py on reproducible corpora, and compare the
+results with a baseline.
+
+The synthetic corpora are generated from a fixed random seed, so they
+are the same on every machine:
+
+long_lines      statements, strings and comments longer than 79 characters
+deep_nesting    deeply nested blocks and brackets
+giant_literals  dict and list literals of thousands of items
+tabs            tab-indented code
+tiny_files      hundreds of files of a few lines
+typical         ordinary modules with classes, functions and docstrings
+
+The stdlib corpus is a sample of the modules of the running Python.
+
+The startup corpus measures the cold start instead: each trial runs
+pep8.py in a new interpreter on one tiny file, and the rate is in
+starts per second.  Most runs in an editor or a commit hook check a
+handful of files, so the start often costs more than the checks.
+
+Each corpus is loaded in memory, then checked several times; the best
+time counts.  For example, to save a baseline and compare with it
+after a change:
+
+$ python benchmark.py --save=baseline.json
+$ python benchmark.py --compare=baseline.json --threshold=10
+
+The exit code is 1 if the throughput of a corpus dropped by more than
+the threshold (in percent).
+"""
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+import pep8
+
+SYNTHETIC_CORPORA = ('long_lines', 'deep_nesting', 'giant_literals',
+                     'tabs', 'tiny_files', 'typical')
+NAMES = ('alpha', 'beta', 'gamma', 'delta', 'epsilon', 'spam', 'ham',
+         'eggs', 'result', 'value', 'items', 'index', 'total', 'node')
+
+
+##############################################################################
+# Generators of synthetic corpora
+##############################################################################
+
+
+def name(rng):
+    return rng.choice(NAMES) + str(rng.randint(0, 99))
+
+
+def expression(rng, length):
+    """
+    Return an arithmetic expression of about length characters.
+    """
+    parts = [name(rng)]
+    while sum([len(part) + 3 for part in parts]) < length:
+        parts.append(rng.choice(['+', '-', '*', '%', '==', '<=']))
+        parts.append(rng.choice([name(rng), str(rng.randint(0, 9999))]))
+    return ' '.join(parts)
+
+
+def long_lines(rng, index):
+    lines = ['"""Module with long lines %d."""\n' % index, '\n']
+    for number in range(200):
+        kind = number % 4
+        if kind == 0:
+            lines.append('%s = %s\n' % (name(rng), expression(rng, 120)))
+        elif kind == 1:
+            lines.append('%s = "%s"\n' % (name(rng), 'x' * 100))
+        elif kind == 2:
+            lines.append('# %s\n' % ' '.join([name(rng) for i in range(15)]))
+        else:
+            lines.append('%s(%s)\n' % (name(rng), ', '.join(
+                ['%s=%s' % (name(rng), name(rng)) for i in range(8)])))
+    return [('long_lines_%d.py' % index, lines)]
+
+
+def deep_nesting(rng, index):
+    lines = ['def %s(%s):\n' % (name(rng), name(rng))]
+    for depth in range(1, 20):
+        indent = '    ' * depth
+        lines.append('%sif %s:\n' % (indent, expression(rng, 20)))
+        lines.append('%s    %s = [(%s, {%s: [%s]})]\n' % (
+            indent, name(rng), name(rng), name(rng), expression(rng, 10)))
+    lines.append('    ' * 20 + 'return (((((((%s)))))))\n' % name(rng))
+    lines.append('\n')
+    lines.append('\n')
+    lines.append('%s = (\n' % name(rng))
+    for depth in range(40):
+        lines.append('    ' * (depth % 10 + 1) + '[%s,\n' % name(rng))
+    lines.append('    ' + ']' * 40 + ')\n')
+    return [('deep_nesting_%d.py' % index, lines)]
+
+
+def giant_literals(rng, index):
+    lines = ['%s = {\n' % name(rng)]
+    for number in range(3000):
+        lines.append("    '%s_%d': [%s, %d, '%s'],\n" % (
+            name(rng), number, name(rng), rng.randint(0, 9999), 'y' * 20))
+    lines.append('}\n')
+    items = ', '.join([str(rng.randint(0, 999)) for i in range(2000)])
+    lines.append('%s = [%s]\n' % (name(rng), items))
+    return [('giant_literals_%d.py' % index, lines)]
+
+
+def tabs(rng, index):
+    lines = []
+    for number in range(40):
+        lines.append('class %s(object):\n' % name(rng).title())
+        lines.append('\n')
+        lines.append('\tdef %s(self, %s):\n' % (name(rng), name(rng)))
+        lines.append('\t\tif %s:\n' % expression(rng, 30))
+        lines.append('\t\t\treturn %s\n' % expression(rng, 40))
+        lines.append('\t\tfor %s in %s:\n' % (name(rng), name(rng)))
+        lines.append('\t\t\t%s += %s\n' % (name(rng), name(rng)))
+        lines.append('\n')
+        lines.append('\n')
+    return [('tabs_%d.py' % index, lines)]
+
+
+def tiny_files(rng, index):
+    files = []
+    for number in range(300):
+        files.append(('tiny_%d_%d.py' % (index, number), [
+            'import %s\n' % name(rng),
+            '\n',
+            '%s = %s.%s(%d)\n' % (name(rng), name(rng), name(rng), number)]))
+    return files
+
+
+def typical(rng, index):
+    lines = ['"""\n', 'Typical module %d.\n' % index, '"""\n', '\n',
+             'import os\n', 'import sys\n', '\n', '\n']
+    for number in range(30):
+        lines.append('class %s(object):\n' % name(rng).title())
+        lines.append('    """Docstring of the class."""\n')
+        lines.append('\n')
+        lines.append('    def __init__(self, %s, %s=None):\n' %
+                     (name(rng), name(rng)))
+        lines.append('        self.%s = %s\n' % (name(rng), name(rng)))
+        lines.append('        self.%s = {%r: %s, %r: [%s, %s]}\n' % (
+            name(rng), name(rng), name(rng), name(rng), name(rng),
+            name(rng)))
+        lines.append('\n')
+        lines.append('    def %s(self, *args, **kwargs):\n' % name(rng))
+        lines.append('        # %s\n' % ' '.join([name(rng)
+                                                  for i in range(5)]))
+        lines.append('        for %s in range(%d):\n' %
+                     (name(rng), rng.randint(1, 99)))
+        lines.append('            if %s:\n' % expression(rng, 40))
+        lines.append('                %s(%s, key=%r)\n' %
+                     (name(rng), name(rng), name(rng)))
+        lines.append('        return %s\n' % expression(rng, 30))
+        lines.append('\n')
+        lines.append('\n')
+    return [('typical_%d.py' % index, lines)]
+
+
+def generate(corpus, seed=0, count=10):
+    """
+    Return the (filename, lines) of a synthetic corpus.
+    """
+    generator = globals()[corpus]
+    rng = random.Random('%s-%s' % (corpus, seed))
+    files = []
+    for index in range(count):
+        files.extend(generator(rng, index))
+    return files
+
+
+def write_corpus(directory, files):
+    """
+    Write the files of a corpus to a directory.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for filename, lines in files:
+        output = open(os.path.join(directory, filename), 'w')
+        try:
+            output.writelines(lines)
+        finally:
+            output.close()
+
+
+def stdlib_corpus(limit):
+    """
+    Return a sample of up to limit modules of the standard library,
+    leaving out those which pep8.py cannot tokenize.
+    """
+    root = os.path.dirname(os.__file__)
+    filenames = []
+    for dirpath, dirnames, files in os.walk(root):
+        dirnames[:] = [dirname for dirname in sorted(dirnames)
+                       if dirname not in ('site-packages', 'test', 'tests')]
+        for filename in sorted(files):
+            if filename.endswith('.py'):
+                filenames.append(os.path.join(dirpath, filename))
+    step = max(1, len(filenames) // limit)
+    files = []
+    style = pep8.StyleGuide(quiet=2)
+    for filename in filenames[::step][:limit]:
+        lines = pep8.readlines(filename)
+        try:
+            pep8.Checker(filename, lines, style).check_all()
+        except Exception:
+            continue  # Syntax not supported by this version of pep8.py
+        files.append((filename, lines))
+    return files
+
+
+##############################################################################
+# Measures
+##############################################################################
+
+
+def measure(files, trials, **pep8_options):
+    """
+    Check the files several times and return the numbers of the best
+    trial.
+    """
+    pep8_options.setdefault('quiet', 2)
+    best = None
+    times = []
+    for trial in range(trials):
+        style = pep8.StyleGuide(**pep8_options)
+        start = pep8.timer()
+        for filename, lines in files:
+            style.input_file(filename, lines)
+        elapsed = pep8.timer() - start
+        times.append(elapsed)
+        if best is None or elapsed < best:
+            best = elapsed
+            counters = style.report.counters
+    times.sort()
+    result = {
+        'files': len(files),
+        'physical lines': counters['physical lines'],
+        'logical lines': counters['logical lines'],
+        'errors': style.report.get_count(),
+        'seconds': best,
+        'median seconds': times[len(times) // 2],
+    }
+    result['lines per second'] = result['physical lines'] / max(best, 1e-9)
+    return result
+
+
+def measure_startup(trials):
+    """
+    Run pep8.py on a tiny file in a new interpreter several times, and
+    return the numbers of the best trial.  The module is imported, as
+    by the installed pep8 script, so that its bytecode may be cached.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        filename, lines = generate('tiny_files', count=1)[0]
+        write_corpus(directory, [(filename, lines)])
+        command = [sys.executable, '-c', 'import pep8; pep8._main()',
+                   os.path.join(directory, filename)]
+        cwd = os.path.dirname(os.path.abspath(pep8.__file__))
+        times = []
+        for trial in range(trials):
+            start = pep8.timer()
+            subprocess.call(command, cwd=cwd, stdout=subprocess.PIPE)
+            times.append(pep8.timer() - start)
+    finally:
+        shutil.rmtree(directory)
+    times.sort()
+    return {
+        'files': 1,
+        'physical lines': len(lines),
+        'seconds': times[0],
+        'median seconds': times[len(times) // 2],
+        'starts per second': 1 / max(times[0], 1e-9),
+    }
+
+
+def rate_key(result):
+    """
+    Return the key of the throughput in the result of a corpus.
+    """
+    if 'starts per second' in result:
+        return 'starts per second'
+    return 'lines per second'
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the change of throughput of each corpus since the baseline,
+    and return the names of the corpora which slowed down by more than
+    threshold percent.
+    """
+    regressions = []
+    print('%-16s %14s %14s %8s' % ('corpus', 'baseline', 'per second',
+                                   'change'))
+    for corpus in sorted(results):
+        if corpus not in baseline:
+            continue
+        key = rate_key(results[corpus])
+        if key not in baseline[corpus]:
+            continue
+        old = baseline[corpus][key]
+        new = results[corpus][key]
+        change = (new - old) * 100.0 / old
+        flag = ''
+        if change < -threshold:
+            regressions.append(corpus)
+            flag = '  REGRESSION'
+        print('%-16s %14d %14d %+7.1f%%%s' % (corpus, old, new, change,
+                                              flag))
+    return regressions
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--corpus', metavar='names',
+                      default=','.join(SYNTHETIC_CORPORA +
+                                       ('stdlib', 'startup')),
+                      help="comma separated corpora to measure "
+                        "(default: all)")
+    parser.add_option('--seed', type='int', default=0,
+                      help="seed of the synthetic corpora (default: 0)")
+    parser.add_option('--stdlib-limit', metavar='n', type='int', default=200,
+                      help="number of stdlib modules (default: 200)")
+    parser.add_option('--trials', metavar='n', type='int', default=5,
+                      help="number of runs per corpus (default: 5)")
+    parser.add_option('--select', metavar='errors', default='',
+                      help="pep8.py --select option")
+    parser.add_option('--ignore', metavar='errors', default='',
+                      help="pep8.py --ignore option")
+    parser.add_option('--write-corpus', metavar='dir',
+                      help="write the synthetic corpora to dir and exit")
+    parser.add_option('--save', metavar='file',
+                      help="save the results to a JSON file")
+    parser.add_option('--compare', metavar='file',
+                      help="compare the results with a saved baseline")
+    parser.add_option('--threshold', metavar='percent', type='float',
+                      default=10.0,
+                      help="slowdown which counts as a regression "
+                        "(default: 10)")
+    options, args = parser.parse_args()
+    corpora = options.corpus.split(',')
+    if options.write_corpus:
+        for corpus in corpora:
+            if corpus in SYNTHETIC_CORPORA:
+                write_corpus(os.path.join(options.write_corpus, corpus),
+                             generate(corpus, options.seed))
+        return
+    results = {}
+    for corpus in corpora:
+        if corpus == 'startup':
+            results[corpus] = measure_startup(max(options.trials, 20))
+            print('%-16s %6d files %8d lines %8.3f s %10d starts/s' % (
+                corpus, results[corpus]['files'],
+                results[corpus]['physical lines'],
+                results[corpus]['seconds'],
+                results[corpus]['starts per second']))
+            continue
+        if corpus == 'stdlib':
+            files = stdlib_corpus(options.stdlib_limit)
+        elif corpus in SYNTHETIC_CORPORA:
+            files = generate(corpus, options.seed)
+        else:
+            parser.error('unknown corpus: %s' % corpus)
+        results[corpus] = measure(files, options.trials,
+                                  select=options.select,
+                                  ignore=options.ignore)
+        print('%-16s %6d files %8d lines %8.3f s %10d lines/s' % (
+            corpus, results[corpus]['files'],
+            results[corpus]['physical lines'], results[corpus]['seconds'],
+            results[corpus]['lines per second']))
+    if options.save or options.compare:
+        import json
+    if options.save:
+        output = open(options.save, 'w')
+        try:
+            json.dump({'pep8': pep8.__version__,
+                       'python': sys.version.split()[0],
+                       'seed': options.seed,
+                       'trials': options.trials,
+                       'results': results}, output, indent=1, sort_keys=True)
+        finally:
+            output.close()
+    if options.compare:
+        baseline = json.load(open(options.compare))['results']
+        if compare(results, baseline, options.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,7 +22,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-"""
+r"""
 Check Python source code formatting, according to PEP 8:
 http://www.python.org/dev/peps/pep-0008/
 
@@ -45,7 +45,11 @@ W warnings
 
 You can add checks to this program by writing plugins. Each plugin is
 a simple function that is called for each line of source code, either
-physical or logical.
+physical or logical.  It is registered with the error codes it reports,
+so that the checks are known without inspecting the module on startup:
+
+@register_check('E501')
+def maximum_line_length(physical_line, encoding)
 
 Physical line:
 - Raw line of text from the input file.
@@ -59,22 +63,75 @@ Logical line:
 The check function requests physical or logical lines by the name of
 the first argument:
 
-def maximum_line_length(physical_line)
+def maximum_line_length(physical_line, encoding)
 def extraneous_whitespace(logical_line)
 def blank_lines(logical_line, blank_lines, indent_level, line_number)
+def whitespace_before_parameters(logical_line, tokens)
+def comparison_to_singleton(tree_lines)
 
-The last example above demonstrates how check plugins can request
+The third example above demonstrates how check plugins can request
 additional information with extra arguments. All attributes of the
 Checker object are available. Some examples:
 
 lines: a list of the raw lines from the input file
-tokens: the tokens that contribute to this logical line
+encoding: the encoding of the raw lines, on Python 2 when they are not
+          pure ASCII (None otherwise)
+tokens: the tokens that contribute to this logical line (a list, or a
+        TokenBuffer with --compact-tokens)
 line_number: line number in the input file
 blank_lines: blank lines before this one
 indent_char: first indentation character in this file (' ' or '\t')
 indent_level: indentation (with tabs expanded to multiples of 8)
 previous_indent_level: indentation on previous line
 previous_logical: previous logical line
+bracket_depth: the brackets open at each offset of the logical line
+enabled_codes: the codes of the checks which --select and --ignore
+               enable, so that a check can skip its disabled branches
+
+A check returns (offset, text) to report an error, or it may be a
+generator which yields (offset, text) for every error it finds.  With
+--first-only, only the first error of each check on a line is reported.
+
+A check whose first argument is token is a generator, which visits the
+tokens of a logical line as they come out of the tokenizer: it gets the
+first token as argument, and each following token as the value of a
+bare yield expression.  It yields (offset, text) to report an error,
+and is resumed with None to go on.  The offset is usually a (line,
+column) tuple.  On CPython, resuming a generator for every token costs
+more than walking the tokens list once per logical line, so the checks
+of this module take the tokens argument instead.
+
+A check whose first argument starts with tree gets the syntax tree of
+the whole file.  The file is parsed once, and only when an enabled check
+asks for the tree, which all these checks share along with a table of
+its nodes by line:
+
+tree: the ast.Module of the input file
+tree_lines: the nodes of the tree which start on each line, by line
+            number
+
+A tree check reports ((line, column), text) for each error, with the
+column of the node.  The tree checks are skipped on a file which does
+not parse, and with --stream.
+
+A check which can only fire when some characters or substrings occur
+in the file may declare them, and it is skipped on the other files:
+
+python_3000_backticks.triggers = ('`',)
+
+A logical check may also declare a regular expression which matches
+every logical line where it can return a result.  With --fused-scan,
+these scanners are combined in one regular expression, which is run
+once on each logical line, and only the checks which it matched are
+run on that line:
+
+python_3000_backticks.scanner = '`'
+
+A physical check may declare the kind of lines where it can return a
+result, among those listed by LineTable.  The file is scanned once for
+each kind, and the check only runs on those lines:
+
+maximum_line_length.table = 'long'
 
 The docstring of each check function shall be the relevant part of
 text from PEP 8. It is printed if the user enables --show-pep8.
@@ -98,31 +155,59 @@ import os
 import sys
 import re
 import time
-import inspect
+import bisect
+import threading
 import keyword
 import tokenize
-from optparse import OptionParser
-from fnmatch import fnmatch
+from array import array
 try:
-    frozenset
-except NameError:
-    from sets import ImmutableSet as frozenset
+    from os import scandir
+except ImportError:
+    scandir = None
+
+
+class LazyRegex(object):
+    """
+    A regular expression which is compiled on first use, so that the
+    module starts without compiling those which a run does not need.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)  # Introspection, not a use
+        regex = re.compile(self.pattern, self.flags)
+        for method in ('match', 'search', 'findall', 'finditer', 'sub'):
+            setattr(self, method, getattr(regex, method))
+        return getattr(regex, name)
 
 
 DEFAULT_EXCLUDE = '.svn,CVS,.bzr,.hg,.git'
-DEFAULT_IGNORE = 'E24'
+DEFAULT_IGNORE = 'E24,E71,E72'
 MAX_LINE_LENGTH = 79
 
-INDENT_REGEX = re.compile(r'([ \t]*)')
-RAISE_COMMA_REGEX = re.compile(r'raise\s+\w+\s*(,)')
-SELFTEST_REGEX = re.compile(r'(Okay|[EW]\d{3}):\s(.*)')
-ERRORCODE_REGEX = re.compile(r'[EW]\d{3}')
-DOCSTRING_REGEX = re.compile(r'u?r?["\']')
+INDENT_REGEX = LazyRegex(r'([ \t]*)')
+RAISE_COMMA_REGEX = LazyRegex(r'raise\s+\w+\s*(,)')
+CODING_REGEX = LazyRegex(r'[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)')
+SELFTEST_REGEX = LazyRegex(r'(Okay|[EW]\d{3}):\s(.*)')
+DOCSTRING_REGEX = LazyRegex(r'u?r?["\']')
 WHITESPACE_AROUND_OPERATOR_REGEX = \
-    re.compile('([^\w\s]*)\s*(\t|  )\s*([^\w\s]*)')
-EXTRANEOUS_WHITESPACE_REGEX = re.compile(r'[[({] | []}),;:]')
+    LazyRegex(r'([^\w\s]*)\s*(\t|  )\s*(?=([^\w\s]*))')
+EXTRANEOUS_WHITESPACE_REGEX = LazyRegex(r'[\[({] | [\]}),;:]')
+MISSING_WHITESPACE_REGEX = LazyRegex(r'[,;:](?=[^ \t])')
+BRACKET_REGEX = LazyRegex(r'[][(){}]')
+LAMBDA_REGEX = LazyRegex(r'\blambda\b')
 WHITESPACE_AROUND_NAMED_PARAMETER_REGEX = \
-    re.compile(r'[()]|\s=[^=]|[^=!<>]=\s')
+    LazyRegex(r'[()]|\s=[^=]|[^=!<>]=\s')
+# The tokens of a line without strings or backslashes, built from the
+# patterns of the tokenize module, in the same order
+SIMPLE_TOKEN_REGEX = LazyRegex(
+    tokenize.Whitespace + r'(?:(?P<newline>\r?\n)|(?P<comment>%s)|'
+    r'(?P<number>%s)|(?P<op>%s)|(?P<name>[a-zA-Z_]\w*))' %
+    (tokenize.Comment, tokenize.Number, tokenize.Funny))
 
 
 WHITESPACE = ' \t'
@@ -134,12 +219,64 @@ UNARY_OPERATORS = frozenset(['>>', '**', '*', '+', '-'])
 OPERATORS = BINARY_OPERATORS | UNARY_OPERATORS
 SKIP_TOKENS = frozenset([tokenize.COMMENT, tokenize.NL, tokenize.INDENT,
                          tokenize.DEDENT, tokenize.NEWLINE])
+SIMPLE_TOKEN_TYPES = {'newline': tokenize.NEWLINE, 'comment': tokenize.COMMENT,
+                      'number': tokenize.NUMBER, 'op': tokenize.OP,
+                      'name': tokenize.NAME}
 E225NOT_KEYWORDS = (frozenset(keyword.kwlist + ['print']) -
                     frozenset(['False', 'None', 'True']))
+STREAM_WINDOW = 1000  # Lines kept at least in memory with --stream
+WALK_THREADS = 8  # Directories listed at once by input_dir
+# With --max-errors-per-file or --fail-fast, the logical checks which find
+# the most errors per microsecond on the standard library run first
+FIRST_CHECKS = ('blank_lines', 'python_3000_raise_comma',
+                'compound_statements', 'missing_whitespace',
+                'python_3000_has_key', 'missing_whitespace_around_operator',
+                'whitespace_before_inline_comment',
+                'imports_on_separate_lines', 'extraneous_whitespace',
+                'whitespace_around_operator',
+                'whitespace_around_named_parameter_equals',
+                'whitespace_around_comma', 'whitespace_before_parameters')
 BENCHMARK_KEYS = ('directories', 'files', 'logical lines', 'physical lines')
+# The stage of check_all which computes each argument of the logical checks
+STAGE_ARGUMENTS = {
+    'logical_line': 'logical_line',
+    'previous_logical': 'logical_line',
+    'indent_level': 'indent_level',
+    'previous_indent_level': 'indent_level',
+    'blank_lines': 'blank_lines',
+    'blank_lines_before_comment': 'blank_lines',
+    'bracket_depth': 'bracket_depth',
+}
+ALL_STAGES = {'tokens': True, 'logical_line': True, 'indent_level': True,
+              'blank_lines': True, 'bracket_depth': True}
+
+timer = getattr(time, 'perf_counter', time.time)
 
 options = None
 args = None
+style_guide = None
+check_plans = None   # Check lists by select and ignore, in --server mode
+memory_cache = None  # Results by cache key, in --server mode
+fused_scanners = {}  # FusedScanner by names of the checks, for --fused-scan
+stage_plans = {}  # Stages of check_all by names of the logical checks
+registered_checks = {}  # (check, argument names) by name, by kind
+
+
+def register_check(*codes):
+    """
+    Return a decorator which registers a check function with the error
+    codes it reports.  The kind of the check is the name of its first
+    argument, and the other arguments name the Checker attributes it
+    takes, as recorded here once and for all.
+    """
+    def register(check):
+        code = check.__code__
+        argument_names = list(code.co_varnames[:code.co_argcount])
+        check.codes = codes
+        registered_checks.setdefault(argument_names[0], {})[
+            check.__name__] = (check, argument_names)
+        return check
+    return register
 
 
 ##############################################################################
@@ -147,6 +284,7 @@ args = None
 ##############################################################################
 
 
+@register_check('E101')
 def tabs_or_spaces(physical_line, indent_char):
     r"""
     Never mix tabs and spaces.
@@ -165,8 +303,11 @@ def tabs_or_spaces(physical_line, indent_char):
     for offset, char in enumerate(indent):
         if char != indent_char:
             return offset, "E101 indentation contains mixed spaces and tabs"
+tabs_or_spaces.triggers = ('\t',)
+tabs_or_spaces.table = 'indented'
 
 
+@register_check('W191')
 def tabs_obsolete(physical_line):
     r"""
     For new projects, spaces-only are strongly recommended over tabs.  Most
@@ -178,9 +319,12 @@ def tabs_obsolete(physical_line):
     indent = INDENT_REGEX.match(physical_line).group(1)
     if indent.count('\t'):
         return indent.index('\t'), "W191 indentation contains tabs"
+tabs_obsolete.triggers = ('\t',)
+tabs_obsolete.table = 'tabbed'
 
 
-def trailing_whitespace(physical_line):
+@register_check('W291', 'W293')
+def trailing_whitespace(physical_line, enabled_codes):
     r"""
     JCR: Trailing whitespace is superfluous.
     FBM: Except when it occurs as part of a blank line (i.e. the line is
@@ -205,11 +349,14 @@ def trailing_whitespace(physical_line):
     stripped = physical_line.rstrip()
     if physical_line != stripped:
         if stripped:
-            return len(stripped), "W291 trailing whitespace"
-        else:
+            if 'W291' in enabled_codes:
+                return len(stripped), "W291 trailing whitespace"
+        elif 'W293' in enabled_codes:
             return 0, "W293 blank line contains whitespace"
+trailing_whitespace.table = 'trailing'
 
 
+@register_check('W391')
 def trailing_blank_lines(physical_line, lines, line_number):
     r"""
     JCR: Trailing blank lines are superfluous.
@@ -217,19 +364,23 @@ def trailing_blank_lines(physical_line, lines, line_number):
     Okay: spam(1)
     W391: spam(1)\n
     """
-    if physical_line.strip() == '' and line_number == len(lines):
+    if physical_line.strip() == '' and not lines[line_number:line_number + 1]:
         return 0, "W391 blank line at end of file"
+trailing_blank_lines.table = 'last'
 
 
+@register_check('W292')
 def missing_newline(physical_line):
     """
     JCR: The last line should have a newline.
     """
     if physical_line.rstrip() == physical_line:
         return len(physical_line), "W292 no newline at end of file"
+missing_newline.table = 'unterminated'
 
 
-def maximum_line_length(physical_line):
+@register_check('E501')
+def maximum_line_length(physical_line, encoding):
     """
     Limit all lines to a maximum of 79 characters.
 
@@ -242,16 +393,22 @@ def maximum_line_length(physical_line):
     """
     line = physical_line.rstrip()
     length = len(line)
-    if length > MAX_LINE_LENGTH:
+    offset = MAX_LINE_LENGTH
+    if length > MAX_LINE_LENGTH and encoding:
+        # Raw line with multi-byte characters: count the characters, and
+        # report the offset in bytes, like the other checks
         try:
-            # The line could contain multi-byte characters
-            if not hasattr(line, 'decode'):   # Python 3
-                line = line.encode('latin-1')
-            length = len(line.decode('utf-8'))
+            chars = line.decode(encoding)
         except UnicodeDecodeError:
             pass
+        else:
+            length = len(chars)
+            if encoding == 'utf-8-sig':
+                encoding = 'utf-8'  # Only the file starts with the BOM
+            offset = len(line) - len(chars[MAX_LINE_LENGTH:].encode(encoding))
     if length > MAX_LINE_LENGTH:
-        return MAX_LINE_LENGTH, "E501 line too long (%d characters)" % length
+        return offset, "E501 line too long (%d characters)" % length
+maximum_line_length.table = 'long'
 
 
 ##############################################################################
@@ -259,9 +416,10 @@ def maximum_line_length(physical_line):
 ##############################################################################
 
 
+@register_check('E301', 'E302', 'E303', 'E304')
 def blank_lines(logical_line, blank_lines, indent_level, line_number,
                 previous_logical, previous_indent_level,
-                blank_lines_before_comment):
+                blank_lines_before_comment, enabled_codes):
     r"""
     Separate top-level function and class definitions with two blank lines.
 
@@ -286,21 +444,24 @@ def blank_lines(logical_line, blank_lines, indent_level, line_number,
         return  # Don't expect blank lines before the first line
     max_blank_lines = max(blank_lines, blank_lines_before_comment)
     if previous_logical.startswith('@'):
-        if max_blank_lines:
+        if max_blank_lines and 'E304' in enabled_codes:
             return 0, "E304 blank lines found after function decorator"
     elif max_blank_lines > 2 or (indent_level and max_blank_lines == 2):
-        return 0, "E303 too many blank lines (%d)" % max_blank_lines
+        if 'E303' in enabled_codes:
+            return 0, "E303 too many blank lines (%d)" % max_blank_lines
     elif (logical_line.startswith('def ') or
           logical_line.startswith('class ') or
           logical_line.startswith('@')):
         if indent_level:
-            if not (max_blank_lines or previous_indent_level < indent_level or
+            if 'E301' in enabled_codes and not (
+                    max_blank_lines or previous_indent_level < indent_level or
                     DOCSTRING_REGEX.match(previous_logical)):
                 return 0, "E301 expected 1 blank line, found 0"
-        elif max_blank_lines != 2:
+        elif max_blank_lines != 2 and 'E302' in enabled_codes:
             return 0, "E302 expected 2 blank lines, found %d" % max_blank_lines
 
 
+@register_check('E201', 'E202', 'E203')
 def extraneous_whitespace(logical_line):
     """
     Avoid extraneous whitespace in the following situations:
@@ -327,15 +488,17 @@ def extraneous_whitespace(logical_line):
         char = text.strip()
         found = match.start()
         if text == char + ' ' and char in '([{':
-            return found + 1, "E201 whitespace after '%s'" % char
-        if text == ' ' + char and line[found - 1] != ',':
+            yield found + 1, "E201 whitespace after '%s'" % char
+        elif text == ' ' + char and line[found - 1] != ',':
             if char in '}])':
-                return found, "E202 whitespace before '%s'" % char
-            if char in ',;:':
-                return found, "E203 whitespace before '%s'" % char
+                yield found, "E202 whitespace before '%s'" % char
+            elif char in ',;:':
+                yield found, "E203 whitespace before '%s'" % char
+extraneous_whitespace.scanner = EXTRANEOUS_WHITESPACE_REGEX.pattern
 
 
-def missing_whitespace(logical_line):
+@register_check('E231')
+def missing_whitespace(logical_line, bracket_depth):
     """
     JCR: Each comma, semicolon or colon should be followed by whitespace.
 
@@ -349,17 +512,17 @@ def missing_whitespace(logical_line):
     E231: foo(bar,baz)
     """
     line = logical_line
-    for index in range(len(line) - 1):
+    for match in MISSING_WHITESPACE_REGEX.finditer(line):
+        index = match.start()
         char = line[index]
-        if char in ',;:' and line[index + 1] not in WHITESPACE:
-            before = line[:index]
-            if char == ':' and before.count('[') > before.count(']'):
-                continue  # Slice syntax, no space required
-            if char == ',' and line[index + 1] == ')':
-                continue  # Allow tuple with only one element: (3,)
-            return index, "E231 missing whitespace after '%s'" % char
+        if char == ':' and bracket_depth.balance(index, '[') > 0:
+            continue  # Slice syntax, no space required
+        if char == ',' and line[index + 1] == ')':
+            continue  # Allow tuple with only one element: (3,)
+        yield index, "E231 missing whitespace after '%s'" % char
 
 
+@register_check('E111', 'E112', 'E113')
 def indentation(logical_line, previous_logical, indent_char,
                 indent_level, previous_indent_level):
     r"""
@@ -379,14 +542,15 @@ def indentation(logical_line, previous_logical, indent_char,
     E113: a = 1\n    b = 2
     """
     if indent_char == ' ' and indent_level % 4:
-        return 0, "E111 indentation is not a multiple of four"
+        yield 0, "E111 indentation is not a multiple of four"
     indent_expect = previous_logical.endswith(':')
     if indent_expect and indent_level <= previous_indent_level:
-        return 0, "E112 expected an indented block"
+        yield 0, "E112 expected an indented block"
     if indent_level > previous_indent_level and not indent_expect:
-        return 0, "E113 unexpected indentation"
+        yield 0, "E113 unexpected indentation"
 
 
+@register_check('E211')
 def whitespace_before_parameters(logical_line, tokens):
     """
     Avoid extraneous whitespace in the following situations:
@@ -407,6 +571,7 @@ def whitespace_before_parameters(logical_line, tokens):
     prev_type = tokens[0][0]
     prev_text = tokens[0][1]
     prev_end = tokens[0][3]
+    before_prev_text = None
     for index in range(1, len(tokens)):
         token_type, text, start, end, line = tokens[index]
         if (token_type == tokenize.OP and
@@ -414,15 +579,17 @@ def whitespace_before_parameters(logical_line, tokens):
             start != prev_end and
             (prev_type == tokenize.NAME or prev_text in '}])') and
             # Syntax "class A (B):" is allowed, but avoid it
-            (index < 2 or tokens[index - 2][1] != 'class') and
+            before_prev_text != 'class' and
             # Allow "return (a.foo for a in range(5))"
             (not keyword.iskeyword(prev_text))):
-            return prev_end, "E211 whitespace before '%s'" % text
+            yield prev_end, "E211 whitespace before '%s'" % text
+        before_prev_text = prev_text
         prev_type = token_type
         prev_text = text
         prev_end = end
 
 
+@register_check('E221', 'E222', 'E223', 'E224')
 def whitespace_around_operator(logical_line):
     """
     Avoid extraneous whitespace in the following situations:
@@ -441,13 +608,15 @@ def whitespace_around_operator(logical_line):
         tab = whitespace == '\t'
         offset = match.start(2)
         if before in OPERATORS:
-            return offset, (tab and "E224 tab after operator" or
-                            "E222 multiple spaces after operator")
+            yield offset, (tab and "E224 tab after operator" or
+                           "E222 multiple spaces after operator")
         elif after in OPERATORS:
-            return offset, (tab and "E223 tab before operator" or
-                            "E221 multiple spaces before operator")
+            yield offset, (tab and "E223 tab before operator" or
+                           "E221 multiple spaces before operator")
+whitespace_around_operator.scanner = r'\t|  '
 
 
+@register_check('E225')
 def missing_whitespace_around_operator(logical_line, tokens):
     r"""
     - Always surround these binary operators with a single space on
@@ -497,7 +666,8 @@ def missing_whitespace_around_operator(logical_line, tokens):
                 # Tolerate the "<>" operator, even if running Python 3
                 pass
             else:
-                return prev_end, "E225 missing whitespace around operator"
+                yield prev_end, "E225 missing whitespace around operator"
+                need_space = False
         elif token_type == tokenize.OP and prev_end is not None:
             if text == '=' and parens:
                 # Allow keyword args or defaults: foo(bar=None).
@@ -516,12 +686,14 @@ def missing_whitespace_around_operator(logical_line, tokens):
                 else:
                     need_space = True
             if need_space and start == prev_end:
-                return prev_end, "E225 missing whitespace around operator"
+                yield prev_end, "E225 missing whitespace around operator"
+                need_space = False
         prev_type = token_type
         prev_text = text
         prev_end = end
 
 
+@register_check('E241', 'E242')
 def whitespace_around_comma(logical_line):
     """
     Avoid extraneous whitespace in the following situations:
@@ -539,13 +711,17 @@ def whitespace_around_comma(logical_line):
     line = logical_line
     for separator in ',;:':
         found = line.find(separator + '  ')
-        if found > -1:
-            return found + 1, "E241 multiple spaces after '%s'" % separator
+        while found > -1:
+            yield found + 1, "E241 multiple spaces after '%s'" % separator
+            found = line.find(separator + '  ', found + 1)
         found = line.find(separator + '\t')
-        if found > -1:
-            return found + 1, "E242 tab after '%s'" % separator
+        while found > -1:
+            yield found + 1, "E242 tab after '%s'" % separator
+            found = line.find(separator + '\t', found + 1)
+whitespace_around_comma.scanner = r'[,;:](?:  |\t)'
 
 
+@register_check('E251')
 def whitespace_around_named_parameter_equals(logical_line):
     """
     Don't use spaces around the '=' sign when used to indicate a
@@ -567,13 +743,16 @@ def whitespace_around_named_parameter_equals(logical_line):
         text = match.group()
         if parens and len(text) == 3:
             issue = "E251 no spaces around keyword / parameter equals"
-            return match.start(), issue
-        if text == '(':
+            yield match.start(), issue
+        elif text == '(':
             parens += 1
         elif text == ')':
             parens -= 1
+whitespace_around_named_parameter_equals.scanner = \
+    r'=(?:(?<=\s=)[^=]|(?<=[^=!<>]=)\s)'
 
 
+@register_check('E261', 'E262')
 def whitespace_before_inline_comment(logical_line, tokens):
     """
     Separate inline comments by at least two spaces.
@@ -590,21 +769,19 @@ def whitespace_before_inline_comment(logical_line, tokens):
     """
     prev_end = (0, 0)
     for token_type, text, start, end, line in tokens:
-        if token_type == tokenize.NL:
-            continue
         if token_type == tokenize.COMMENT:
-            if not line[:start[1]].strip():
-                continue
-            if prev_end[0] == start[0] and start[1] < prev_end[1] + 2:
-                return (prev_end,
-                        "E261 at least two spaces before inline comment")
-            if (len(text) > 1 and text.startswith('#  ')
-                           or not text.startswith('# ')):
-                return start, "E262 inline comment should start with '# '"
-        else:
+            if line[:start[1]].strip():
+                if prev_end[0] == start[0] and start[1] < prev_end[1] + 2:
+                    yield (prev_end,
+                           "E261 at least two spaces before inline comment")
+                if (len(text) > 1 and text.startswith('#  ')
+                               or not text.startswith('# ')):
+                    yield start, "E262 inline comment should start with '# '"
+        elif token_type != tokenize.NL:
             prev_end = end
 
 
+@register_check('E401')
 def imports_on_separate_lines(logical_line):
     r"""
     Imports should usually be on separate lines.
@@ -623,9 +800,12 @@ def imports_on_separate_lines(logical_line):
         found = line.find(',')
         if found > -1:
             return found, "E401 multiple imports on one line"
+imports_on_separate_lines.triggers = ('import',)
+imports_on_separate_lines.scanner = r'^import .*,'
 
 
-def compound_statements(logical_line):
+@register_check('E701', 'E702')
+def compound_statements(logical_line, bracket_depth):
     r"""
     Compound statements (multiple statements on the same line) are
     generally discouraged.
@@ -653,16 +833,19 @@ def compound_statements(logical_line):
     line = logical_line
     found = line.find(':')
     if -1 < found < len(line) - 1:
-        before = line[:found]
-        if (before.count('{') <= before.count('}') and  # {'a': 1} (dict)
-            before.count('[') <= before.count(']') and  # [1:2] (slice)
-            not re.search(r'\blambda\b', before)):      # lambda x: x
-            return found, "E701 multiple statements on one line (colon)"
+        if (bracket_depth.balance(found, '{') <= 0 and  # {'a': 1} (dict)
+            bracket_depth.balance(found, '[') <= 0 and  # [1:2] (slice)
+            not LAMBDA_REGEX.search(line, 0, found)):  # lambda x: x
+            yield found, "E701 multiple statements on one line (colon)"
     found = line.find(';')
-    if -1 < found:
-        return found, "E702 multiple statements on one line (semicolon)"
+    while -1 < found:
+        yield found, "E702 multiple statements on one line (semicolon)"
+        found = line.find(';', found + 1)
+compound_statements.triggers = (':', ';')
+compound_statements.scanner = r':.|;'
 
 
+@register_check('W601')
 def python_3000_has_key(logical_line):
     """
     The {}.has_key() method will be removed in the future version of
@@ -670,12 +853,19 @@ def python_3000_has_key(logical_line):
     d = {"a": 1, "b": 2}
     if "b" in d:
         print d["b"]
+
+    Okay: found = "alpha" in d
+    W601: assert d.has_key('alpha')
     """
     pos = logical_line.find('.has_key(')
-    if pos > -1:
-        return pos, "W601 .has_key() is deprecated, use 'in'"
+    while pos > -1:
+        yield pos, "W601 .has_key() is deprecated, use 'in'"
+        pos = logical_line.find('.has_key(', pos + 1)
+python_3000_has_key.triggers = ('.has_key(',)
+python_3000_has_key.scanner = r'\.has_key\('
 
 
+@register_check('W602')
 def python_3000_raise_comma(logical_line):
     """
     When raising an exception, use "raise ValueError('message')"
@@ -685,31 +875,121 @@ def python_3000_raise_comma(logical_line):
     are long or include string formatting, you don't need to use line
     continuation characters thanks to the containing parentheses.  The older
     form will be removed in Python 3000.
+
+    Okay: raise DummyError("Message")
+    W602: raise DummyError, "Message"
     """
     match = RAISE_COMMA_REGEX.match(logical_line)
     if match:
         return match.start(1), "W602 deprecated form of raising exception"
+python_3000_raise_comma.triggers = ('raise',)
+python_3000_raise_comma.scanner = '^' + RAISE_COMMA_REGEX.pattern
 
 
+@register_check('W603')
 def python_3000_not_equal(logical_line):
     """
     != can also be written <>, but this is an obsolete usage kept for
     backwards compatibility only. New code should always use !=.
     The older syntax is removed in Python 3000.
+
+    Okay: if a != 'no':
+    W603: if a <> 'no':
     """
     pos = logical_line.find('<>')
-    if pos > -1:
-        return pos, "W603 '<>' is deprecated, use '!='"
+    while pos > -1:
+        yield pos, "W603 '<>' is deprecated, use '!='"
+        pos = logical_line.find('<>', pos + 1)
+python_3000_not_equal.triggers = ('<>',)
+python_3000_not_equal.scanner = '<>'
 
 
+@register_check('W604')
 def python_3000_backticks(logical_line):
     """
     Backticks are removed in Python 3000.
     Use repr() instead.
+
+    Okay: val = repr(1 + 2)
+    W604: val = `1 + 2`
     """
     pos = logical_line.find('`')
-    if pos > -1:
-        return pos, "W604 backticks are deprecated, use 'repr()'"
+    while pos > -1:
+        yield pos, "W604 backticks are deprecated, use 'repr()'"
+        end = logical_line.find('`', pos + 1)
+        if end < 0:
+            break
+        pos = logical_line.find('`', end + 1)
+python_3000_backticks.triggers = ('`',)
+python_3000_backticks.scanner = '`'
+
+
+##############################################################################
+# Plugins (check functions) for syntax trees
+##############################################################################
+
+
+@register_check('E711', 'E712')
+def comparison_to_singleton(tree_lines):
+    r"""
+    Comparisons to singletons like None should always be done with
+    'is' or 'is not', never the equality operators.
+
+    Okay: if arg is not None:\n    pass
+    Okay: if x == none:\n    pass
+    E711: if arg != None:\n    pass
+    E711: if None == arg:\n    pass
+    E712: if arg == True:\n    pass
+    E712: while 0 < arg != False:\n    pass
+    """
+    for nodes in tree_lines.values():
+        for node in nodes:
+            if node.__class__.__name__ != 'Compare':
+                continue
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                if op.__class__.__name__ in ('Eq', 'NotEq'):
+                    for operand in (left, right):
+                        singleton = singleton_name(operand)
+                        if singleton is None:
+                            continue
+                        negation = ''
+                        if op.__class__.__name__ == 'NotEq':
+                            negation = 'not '
+                        code = 'E712'
+                        if singleton == 'None':
+                            code = 'E711'
+                        yield ((operand.lineno, operand.col_offset),
+                               "%s comparison to %s should be "
+                               "'if cond is %s%s:'" %
+                               (code, singleton, negation, singleton))
+                left = right
+comparison_to_singleton.triggers = ('None', 'True', 'False')
+
+
+@register_check('E721')
+def comparison_type(tree_lines):
+    r"""
+    Object type comparisons should always use isinstance() instead
+    of comparing types directly.
+
+    Okay: if isinstance(obj, int):\n    pass
+    Okay: if type(obj) is type(1):\n    pass
+    E721: if type(obj) == type(1):\n    pass
+    E721: if type(a1) != int:\n    pass
+    """
+    for nodes in tree_lines.values():
+        for node in nodes:
+            if node.__class__.__name__ != 'Compare':
+                continue
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                if (op.__class__.__name__ in ('Eq', 'NotEq') and
+                        (is_type_call(left) or is_type_call(right))):
+                    yield ((left.lineno, left.col_offset),
+                           "E721 do not compare types, use 'isinstance()'")
+                left = right
+comparison_type.triggers = ('type',)
 
 
 ##############################################################################
@@ -717,16 +997,123 @@ def python_3000_backticks(logical_line):
 ##############################################################################
 
 
+def readlines(filename):
+    """
+    Read a source file in one go, and return its lines.
+    """
+    source_file = open(filename, 'rb')
+    try:
+        data = source_file.read()
+    finally:
+        source_file.close()
+    return decode_lines(data)
+
+
 if '' == ''.encode():
-    # Python 2: implicit encoding.
-    def readlines(filename):
-        return open(filename).readlines()
+    # Python 2: the lines stay raw bytes, and are only decoded where a
+    # number of characters is needed, in files which are not pure ASCII.
+    def decode_lines(data):
+        import cStringIO
+        return cStringIO.StringIO(data).readlines()
+
+    def open_lines(filename):
+        """
+        Open a source file for reading line by line.  Return the file
+        and the encoding of its raw lines, found in the first two.
+        """
+        source_file = open(filename)
+        encoding = detect_encoding([source_file.readline(),
+                                    source_file.readline()])
+        source_file.seek(0)
+        return source_file, encoding
+
+    def source_encoding(lines):
+        """
+        Return the encoding of raw lines which are not pure ASCII, or
+        None if they do not need decoding.
+        """
+        source = ''.join(lines)
+        if not isinstance(source, str):
+            return None  # Already decoded
+        try:
+            source.decode('ascii')
+        except UnicodeDecodeError:
+            return detect_encoding(lines)
+
+    def detect_encoding(lines):
+        """
+        Return the encoding declared by the BOM or by the PEP 263 coding
+        cookie of the raw lines, or UTF-8, like tokenize.detect_encoding.
+
+        >>> detect_encoding(['#!/usr/bin/python\\n', '# vim: coding=latin-1'])
+        'latin-1'
+        >>> detect_encoding(['\\xef\\xbb\\xbfx = 1\\n'])
+        'utf-8-sig'
+        """
+        import codecs
+        if lines and lines[0].startswith(codecs.BOM_UTF8):
+            return 'utf-8-sig'  # Decoded, the BOM is not a character
+        for line in lines[:2]:
+            match = CODING_REGEX.match(line)
+            if match:
+                try:
+                    codecs.lookup(match.group(1))
+                except LookupError:
+                    break
+                return match.group(1)
+            if line.strip() and not line.lstrip().startswith('#'):
+                break  # The cookie must come before any code
+        return 'utf-8'
 else:
-    # Python 3: decode to latin-1.
-    # This function is lazy, it does not read the encoding declaration.
-    # XXX: use tokenize.detect_encoding()
-    def readlines(filename):
-        return open(filename, encoding='latin-1').readlines()
+    # Python 3: decode with the encoding declared by the BOM or the coding
+    # cookie, after a check for pure ASCII which is the fast common case.
+    def decode_lines(data):
+        import io
+        try:
+            data.decode('ascii')
+            encoding = 'ascii'
+        except UnicodeDecodeError:
+            try:
+                encoding = tokenize.detect_encoding(
+                    io.BytesIO(data).readline)[0]
+                data.decode(encoding)
+            except (SyntaxError, UnicodeDecodeError):
+                encoding = 'latin-1'  # Wrong or missing declaration
+        return io.TextIOWrapper(io.BytesIO(data),
+                                encoding=encoding).readlines()
+
+    def open_lines(filename):
+        """
+        Open a source file for reading line by line, decoded with the
+        encoding declared by its BOM or its coding cookie.  Return the
+        file and None: the lines are text.
+
+        Like decode_lines, a file which does not decode with its declared
+        encoding is read as latin-1.  The file is decoded once ahead in
+        blocks to find out, so that the memory stays bounded.
+        """
+        import io
+        import codecs
+        binary = open(filename, 'rb')
+        try:
+            encoding = tokenize.detect_encoding(binary.readline)[0]
+            binary.seek(0)
+            decoder = codecs.getincrementaldecoder(encoding)()
+            block = binary.read(65536)
+            while block:
+                decoder.decode(block)
+                block = binary.read(65536)
+            decoder.decode(''.encode(), True)
+        except (SyntaxError, UnicodeDecodeError):
+            encoding = 'latin-1'  # Wrong or missing declaration
+        binary.seek(0)
+        return io.TextIOWrapper(binary, encoding=encoding), None
+
+    def source_encoding(lines):
+        """
+        Return None: the lines are decoded as they are read.
+        """
+        return None
 
 
 def expand_indent(line):
@@ -756,6 +1143,31 @@ def expand_indent(line):
     return result
 
 
+def singleton_name(node):
+    """
+    Return 'None', 'True' or 'False' when a syntax tree node is one of
+    these singletons, or None.
+    """
+    kind = node.__class__.__name__
+    if kind == 'Name' and node.id in ('None', 'True', 'False'):
+        return node.id  # Python 2
+    if kind in ('Constant', 'NameConstant'):
+        for singleton in (None, True, False):
+            if node.value is singleton:
+                return str(singleton)
+    return None
+
+
+def is_type_call(node):
+    """
+    Tell if a syntax tree node calls type() with one argument.
+    """
+    return (node.__class__.__name__ == 'Call' and
+            node.func.__class__.__name__ == 'Name' and
+            node.func.id == 'type' and len(node.args) == 1 and
+            not node.keywords)
+
+
 def mute_string(text):
     """
     Replace contents with 'xxx' to prevent syntax matching.
@@ -767,6 +1179,17 @@ def mute_string(text):
     >>> mute_string("r'abc'")
     "r'xxx'"
     """
+    start, end = string_contents(text)
+    return text[:start] + 'x' * (end - start) + text[end:]
+
+
+def string_contents(text):
+    """
+    Return the start and end offsets of the contents of a string.
+
+    >>> string_contents("r'''abc'''")
+    (4, 7)
+    """
     start = 1
     end = len(text) - 1
     # String modifiers (e.g. u or r)
@@ -778,7 +1201,462 @@ def mute_string(text):
     if text.endswith('"""') or text.endswith("'''"):
         start += 2
         end -= 2
-    return text[:start] + 'x' * (end - start) + text[end:]
+    return start, end
+
+
+class TokenBuffer(object):
+    """
+    The tokens of a logical line, stored in parallel arrays of numbers.
+
+    The type, start and end of each token are kept in arrays, and its
+    text and line are sliced from the source lines when needed.  Only
+    the tokens which are not a slice of a single source line, like
+    multi-line strings, keep their own text and line.
+
+    A token buffer is a sequence of the usual 5-tuples:
+
+    >>> lines = ['x = (1,\\n', '     2)\\n']
+    >>> source = lines + ['']
+    >>> tokens = TokenBuffer(lines)
+    >>> for token in tokenize.generate_tokens(lambda: source.pop(0)):
+    ...     tokens.append(token)
+    >>> tokens[2][1:4]
+    ('(', (1, 4), (1, 5))
+    >>> [token[1] for token in tokens[-4:]]
+    ['2', ')', '\\n', '']
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.types = array('h')
+        self.start_rows = array('l')
+        self.start_columns = array('l')
+        self.end_rows = array('l')
+        self.end_columns = array('l')
+        self.texts = {}  # index: text which is not sliced from its line
+        self.physical = {}  # index: line which is not from self.lines
+
+    def append(self, token):
+        token_type, text, start, end, line = token
+        index = len(self.types)
+        self.types.append(token_type)
+        self.start_rows.append(start[0])
+        self.start_columns.append(start[1])
+        self.end_rows.append(end[0])
+        self.end_columns.append(end[1])
+        if start[0] > len(self.lines) or line is not self.lines[start[0] - 1]:
+            self.physical[index] = line
+        if (start[0] != end[0] or len(text) != end[1] - start[1] or
+            not line.startswith(text, start[1])):
+            self.texts[index] = text
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self.types)
+        start = self.start_rows[index], self.start_columns[index]
+        end = self.end_rows[index], self.end_columns[index]
+        if index in self.physical:
+            line = self.physical[index]
+        else:
+            line = self.lines[start[0] - 1]
+        if index in self.texts:
+            text = self.texts[index]
+        else:
+            text = line[start[1]:end[1]]
+        return self.types[index], text, start, end, line
+
+    def __iter__(self):
+        for index in range(len(self.types)):
+            yield self[index]
+
+
+class FastLexer(object):
+    """
+    Tokenize a source file like tokenize.generate_tokens, with a fast
+    path for the simple statements: those which fit on one line, without
+    strings and without backslashes.  Each other statement is handed to
+    tokenize, from its first line to its NEWLINE token, and its tokens
+    are moved to the rows where it starts.
+
+    The simple attribute tells if the last NEWLINE token came from the
+    fast path, and so if the logical line is a slice of its source line:
+
+    >>> source = ['if x:\\n', '    y = [1,\\n', '         2]\\n', 'z\\n']
+    >>> lines = iter(source)
+    >>> lexer = FastLexer(lambda: next(lines, ''))
+    >>> for token in lexer.generate_tokens():
+    ...     if token[0] == tokenize.NEWLINE:
+    ...         print('%s %s' % (token[2][0], lexer.simple))
+    1 True
+    3 False
+    4 True
+    >>> compare_lexers(source)
+    """
+
+    def __init__(self, readline):
+        self.readline = readline
+        self.row = 0
+        self.eof = False
+        self.indents = [0]
+        self.simple = False
+
+    def next_line(self):
+        """
+        Read the next line, and nothing more after the end of the file.
+        """
+        if self.eof:
+            return ''
+        line = self.readline()
+        self.row += 1
+        if not line:
+            self.eof = True
+        return line
+
+    def generate_tokens(self):
+        """
+        Generate the tokens of the file, as 5-tuples.
+        """
+        while not self.eof:
+            line = self.next_line()
+            row = self.row
+            pos = len(line) - len(line.lstrip(' \t\f'))
+            if pos == len(line):
+                break  # End of file, maybe after some whitespace
+            if line[pos] in '#\r\n':
+                # Comments and blank lines do not change the indentation
+                if line[pos] == '#':
+                    comment = line[pos:].rstrip('\r\n')
+                    yield (tokenize.COMMENT, comment, (row, pos),
+                           (row, pos + len(comment)), line)
+                    pos += len(comment)
+                yield (tokenize.NL, line[pos:], (row, pos),
+                       (row, len(line)), line)
+                continue
+            for token in self.indent_tokens(line, row, pos):
+                yield token
+            tokens = self.simple_tokens(line, row, pos)
+            self.simple = tokens is not None
+            if tokens is None:
+                tokens = self.statement_tokens(line, row)
+            for token in tokens:
+                yield token
+        for indent in self.indents[1:]:
+            yield (tokenize.DEDENT, '', (self.row, 0), (self.row, 0), '')
+        yield (tokenize.ENDMARKER, '', (self.row, 0), (self.row, 0), '')
+
+    def indent_tokens(self, line, row, pos):
+        """
+        Return the INDENT or DEDENT tokens at the start of a statement.
+        Tabs are expanded to the next multiple of 8, like tokenize does.
+        """
+        indent = line[:pos]
+        column = pos
+        if '\t' in indent or '\f' in indent:
+            column = 0
+            for char in indent:
+                if char == '\t':
+                    column = column // 8 * 8 + 8
+                elif char == '\f':
+                    column = 0
+                else:
+                    column += 1
+        tokens = []
+        if column > self.indents[-1]:
+            self.indents.append(column)
+            tokens.append((tokenize.INDENT, indent, (row, 0), (row, pos),
+                           line))
+        while column < self.indents[-1]:
+            if column not in self.indents:
+                raise IndentationError(
+                    "unindent does not match any outer indentation level",
+                    ("<tokenize>", row, pos, line))
+            self.indents.pop()
+            tokens.append((tokenize.DEDENT, '', (row, pos), (row, pos), line))
+        return tokens
+
+    def simple_tokens(self, line, row, pos):
+        """
+        Return the tokens of a simple statement from pos to the end of
+        its line, or None if the statement is not simple.
+        """
+        if '"' in line or "'" in line or '\\' in line:
+            return None
+        tokens = []
+        kind = None
+        depth = 0
+        for match in SIMPLE_TOKEN_REGEX.finditer(line, pos):
+            if match.start() != pos:
+                return None  # Skipped a character which is not a token
+            kind = match.lastgroup
+            start, pos = match.span(kind)
+            text = line[start:pos]
+            if kind == 'op':
+                if text in '([{':
+                    depth += 1
+                elif text in ')]}':
+                    depth -= 1
+            tokens.append((SIMPLE_TOKEN_TYPES[kind], text, (row, start),
+                           (row, pos), line))
+        if kind != 'newline' or pos != len(line) or depth:
+            return None
+        return tokens
+
+    def statement_tokens(self, line, row):
+        """
+        Generate the tokens of a statement with tokenize, which reads its
+        first line, then its continuation lines.  The INDENT token of the
+        first line is left out, since indent_tokens took care of it.
+        """
+        lines = [line]
+
+        def readline():
+            if lines:
+                return lines.pop()
+            return self.next_line()
+        offset = row - 1
+        try:
+            for token in tokenize.generate_tokens(readline):
+                token_type, text, start, end, source = token
+                if token_type == tokenize.INDENT:
+                    continue
+                if token_type in (tokenize.DEDENT, tokenize.ENDMARKER):
+                    return  # End of file
+                yield (token_type, text, (start[0] + offset, start[1]),
+                       (end[0] + offset, end[1]), source)
+                if token_type == tokenize.NEWLINE:
+                    return
+        except tokenize.TokenError:
+            text, (error_row, column) = sys.exc_info()[1].args
+            raise tokenize.TokenError(text, (error_row + offset, column))
+
+
+def compare_lexers(lines):
+    """
+    Tokenize the lines with tokenize and with FastLexer, and return a
+    description of the first difference, or None.  The errors raised by
+    the lexers must be the same too.
+    """
+    results = []
+    for generate in (tokenize.generate_tokens,
+                     lambda readline: FastLexer(readline).generate_tokens()):
+        source = iter(lines)
+        tokens = []
+        try:
+            for token in generate(lambda: next(source, '')):
+                tokens.append(tuple(token))
+        except (tokenize.TokenError, IndentationError):
+            error = sys.exc_info()[1]
+            tokens.append((error.__class__.__name__, error.args))
+        results.append(tokens)
+    expected, found = results
+    for index in range(max(len(expected), len(found))):
+        if index >= len(expected) or index >= len(found) or \
+           expected[index] != found[index]:
+            return 'token %d: tokenize %r, fast lexer %r' % (
+                index, expected[index:index + 1], found[index:index + 1])
+
+
+class LineTable(object):
+    """
+    The lines of a source file where the physical checks can return a
+    result, by kind of line.  Each kind is found on first use, with one
+    pass over the lines, and listed as line indexes:
+
+    >>> table = LineTable(['if x:\\n', '\\ty = 1  \\n', 'z'])
+    >>> table.get('tabbed'), table.get('trailing'), table.get('unterminated')
+    ([1], [1], [2])
+    >>> table.indent_char()
+    '\\t'
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.tables = {}
+
+    def get(self, kind):
+        """
+        Return the indexes of the lines of this kind.
+        """
+        if kind not in self.tables:
+            self.tables[kind] = getattr(self, 'find_' + kind)()
+        return self.tables[kind]
+
+    def indent_char(self):
+        """
+        Return the first indentation character of the file, or None.
+        """
+        indented = self.get('indented')
+        if indented:
+            return self.lines[indented[0]][0]
+
+    def find_indented(self):
+        """Lines which start with a space or a tab."""
+        return [index for index, line in enumerate(self.lines)
+                if line.startswith(' ') or line.startswith('\t')]
+
+    def find_tabbed(self):
+        """Indented lines which contain a tab."""
+        lines = self.lines
+        return [index for index in self.get('indented')
+                if '\t' in lines[index]]
+
+    def find_trailing(self):
+        """Lines which end with whitespace before their newline."""
+        return [index for index, line in enumerate(self.lines)
+                if line[-2:-1].isspace() or
+                (line[-1:] != '\n' and line[-1:].isspace())]
+
+    def find_unterminated(self):
+        """Lines which do not end with whitespace."""
+        return [index for index, line in enumerate(self.lines)
+                if not line[-1:].isspace()]
+
+    def find_long(self):
+        """Lines longer than MAX_LINE_LENGTH, newline included."""
+        return [index for index, line in enumerate(self.lines)
+                if len(line) > MAX_LINE_LENGTH]
+
+    def find_last(self):
+        """The last line."""
+        return list(range(len(self.lines)))[-1:]
+
+
+class LineWindow(object):
+    """
+    The lines of a source file, read on demand through a buffered file,
+    for --stream.  Only the last lines read are kept, at least size of
+    them, so the memory does not grow with the size of the file.
+
+    Indexing a line beyond those read so far reads ahead up to it; the
+    length is the number of lines read so far.  A line which has left
+    the window raises IndexError, like a line after the end of the file.
+    """
+
+    def __init__(self, filename, size=STREAM_WINDOW):
+        self.source, self.encoding = open_lines(filename)
+        self.size = size
+        self.window = []
+        self.start = 0  # Index of the first line of the window
+        self.count = 0
+
+    def read_until(self, count):
+        """
+        Read lines until count lines are read or the file ends.
+        """
+        while self.count < count and self.source is not None:
+            line = self.source.readline()
+            if not line:
+                self.source.close()
+                self.source = None
+                break
+            self.window.append(line)
+            self.count += 1
+            if len(self.window) >= 2 * self.size:
+                del self.window[:self.size]
+                self.start += self.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.start or 0, index.stop, index.step
+            if stop is None:
+                raise IndexError('cannot read a stream to the end')
+            self.read_until(stop)
+            return [self[i] for i in range(start, min(stop, self.count),
+                                           step or 1)]
+        if index < 0:
+            raise IndexError('negative index in a stream')
+        self.read_until(index + 1)
+        if index >= self.count:
+            raise IndexError('line index out of range')
+        if index < self.start:
+            raise IndexError('line %d has left the window' % (index + 1))
+        return self.window[index - self.start]
+
+
+class BracketDepth(object):
+    """
+    The brackets of a logical line, indexed on demand.
+
+    The index is built on the first query, with a single pass over the
+    brackets of the line, and each query is a binary search:
+
+    >>> depth = BracketDepth('a[1:(2)], {b: [c]}')
+    >>> depth.balance(3, '['), depth.balance(10, '{')
+    (1, 0)
+    >>> depth.depth(5), depth.opening(5), depth.opening(12)
+    (2, '(', '{')
+    """
+    closing = {')': '(', ']': '[', '}': '{'}
+
+    def __init__(self, logical_line):
+        self.logical_line = logical_line
+        self.offsets = None
+
+    def build(self):
+        self.offsets = []
+        # Balance of each kind, open brackets and their depth, before
+        # each bracket and after the last one.
+        balance = {'(': 0, '[': 0, '{': 0}
+        stack = ()
+        depth = 0
+        self.balances = [balance.copy()]
+        self.stacks = [stack]
+        self.depths = [depth]
+        for match in BRACKET_REGEX.finditer(self.logical_line):
+            char = match.group()
+            self.offsets.append(match.start())
+            if char in balance:
+                balance[char] += 1
+                stack = (char, stack)
+                depth += 1
+            else:
+                balance[self.closing[char]] -= 1
+                if stack:
+                    stack = stack[1]
+                    depth -= 1
+            self.balances.append(balance.copy())
+            self.stacks.append(stack)
+            self.depths.append(depth)
+
+    def index(self, offset):
+        """
+        Return the number of brackets before offset.
+        """
+        if self.offsets is None:
+            self.build()
+        return bisect.bisect_left(self.offsets, offset)
+
+    def balance(self, offset, char):
+        """
+        Return the number of opening brackets of this kind minus the
+        number of closing ones before offset.
+        """
+        index = self.index(offset)
+        return self.balances[index][char]
+
+    def depth(self, offset):
+        """
+        Return the number of brackets open at offset.
+        """
+        index = self.index(offset)
+        return self.depths[index]
+
+    def opening(self, offset):
+        """
+        Return the innermost bracket open at offset, or None.
+        """
+        index = self.index(offset)
+        stack = self.stacks[index]
+        if stack:
+            return stack[0]
 
 
 def message(text):
@@ -793,50 +1671,148 @@ def message(text):
 ##############################################################################
 
 
-def find_checks(argument_name):
+class FusedScanner(object):
+    """
+    Scan a logical line for the scanners of several checks at once, and
+    tell which checks cannot return a result on that line.
+
+    The scanners are combined in one regular expression.  At each match,
+    the scanners which match there are found, and the scan goes on with
+    the combination of the other ones, so a line without any match is
+    traversed only once.
+    """
+
+    def __init__(self, checks):
+        self.names = []
+        self.scanners = {}
+        self.combined = {}
+        for name, check, argument_names in checks:
+            if getattr(check, 'scanner', None):
+                self.names.append(name)
+                self.scanners[name] = re.compile(check.scanner)
+
+    def combine(self, names):
+        """
+        Return the combined regular expression of some scanners.
+        """
+        key = tuple(names)
+        if key not in self.combined:
+            self.combined[key] = re.compile('|'.join(
+                ['(?:%s)' % self.scanners[name].pattern for name in names]))
+        return self.combined[key]
+
+    def skipped(self, logical_line):
+        """
+        Return the names of the checks which cannot return a result on
+        this logical line.
+        """
+        remaining = self.names
+        offset = 0
+        while remaining:
+            match = self.combine(remaining).search(logical_line, offset)
+            if match is None:
+                break
+            offset = match.start()
+            remaining = [name for name in remaining
+                         if not self.scanners[name].match(logical_line,
+                                                          offset)]
+            offset += 1
+        return remaining
+
+
+def fused_scanner(checks):
     """
-    Find all globally visible functions where the first argument name
-    starts with argument_name.
+    Return the FusedScanner of a list of checks, or None if none of
+    them declares a scanner.  The scanners are compiled once for each
+    combination of checks.
+    """
+    key = tuple([name for name, check, argument_names in checks])
+    if key not in fused_scanners:
+        scanner = FusedScanner(checks)
+        if not scanner.names:
+            scanner = None
+        fused_scanners[key] = scanner
+    return fused_scanners[key]
+
+
+def plan_stages(checks):
+    """
+    Return the stages of check_all which a list of logical checks
+    consume, as a dictionary of stage names.
+
+    Without logical checks, the file is not tokenized at all.  The
+    logical line is only built for the checks which are not token
+    checks, and the indent levels, the blank lines and the bracket
+    depth only for the checks which request them.
+    """
+    key = tuple([name for name, check, argument_names in checks])
+    if key not in stage_plans:
+        stages = {}
+        for name, check, argument_names in checks:
+            stages['tokens'] = True
+            if argument_names[0] != 'token':
+                stages['logical_line'] = True
+            for argument_name in argument_names:
+                if argument_name in STAGE_ARGUMENTS:
+                    stages[STAGE_ARGUMENTS[argument_name]] = True
+        stage_plans[key] = stages
+    return stage_plans[key]
+
+
+class StopChecking(Exception):
+    """
+    Raised by Checker.report_error when the outcome is decided: the file
+    reached --max-errors-per-file, or the run found an error with
+    --fail-fast.
     """
-    checks = []
-    for name, function in globals().items():
-        if not inspect.isfunction(function):
-            continue
-        args = inspect.getargspec(function)[0]
-        if args and args[0].startswith(argument_name):
-            codes = ERRORCODE_REGEX.findall(inspect.getdoc(function) or '')
-            for code in codes or ['']:
-                if not code or not ignore_code(code):
-                    checks.append((name, function, args))
-                    break
-    checks.sort()
-    return checks
 
 
 class Checker(object):
     """
     Load a Python source file, tokenize it, check coding style.
+
+    The options, the checks and the report come from the style guide,
+    which defaults to the one configured by process_options.
     """
 
-    def __init__(self, filename, lines=None):
+    def __init__(self, filename, lines=None, style=None):
+        if style is None:
+            style = style_guide
+        self.style = style
+        self.options = style.options
+        self.report = style.report
+        self.physical_checks = self.options.physical_checks
+        self.logical_checks = self.options.logical_checks
+        self.tree_checks = self.options.tree_checks
         self.filename = filename
         if filename is None:
             self.filename = 'stdin'
             self.lines = lines or []
+        elif lines is None and self.options.stream:
+            self.lines = LineWindow(filename)
         elif lines is None:
             self.lines = readlines(filename)
         else:
             self.lines = lines
-        options.counters['physical lines'] += len(self.lines)
+        self.streaming = isinstance(self.lines, LineWindow)
+        self.results = None
+        self.encoding = None
+        self.enabled_codes = style.enabled_codes
+        self.error_limit = self.options.max_errors_per_file
+        if self.options.fail_fast:
+            self.error_limit = 1
+        if not self.streaming:
+            self.report.increment('physical lines', len(self.lines))
 
     def readline(self):
         """
         Get the next line from the input buffer.
         """
         self.line_number += 1
-        if self.line_number > len(self.lines):
+        try:
+            return self.lines[self.line_number - 1]
+        except IndexError:
             return ''
-        return self.lines[self.line_number - 1]
 
     def readline_check_physical(self):
         """
@@ -859,22 +1835,153 @@ class Checker(object):
 
     def check_physical(self, line):
         """
-        Run all physical checks on a raw input line.
+        Run all physical checks on a raw input line.  The results of
+        the table checks on this line were found by check_table.
         """
         self.physical_line = line
         if self.indent_char is None and len(line) and line[0] in ' \t':
             self.indent_char = line[0]
-        for name, check, argument_names in options.physical_checks:
+        results = self.table_results.get(self.line_number, [])
+        for name, check, argument_names in self.line_checks:
             result = self.run_check(check, argument_names)
             if result is not None:
-                offset, text = result
-                self.report_error(self.line_number, offset, text, check)
+                results = results + [(name, found, check) for found
+                                     in self.check_results(result)]
+                results.sort(key=lambda result: result[:2])
+        for name, (offset, text), check in results:
+            self.report_error(self.line_number, offset, text, check)
+
+    def check_table(self, checks):
+        """
+        Run the physical checks which declare a table on the lines of
+        that kind, and return their results by line number.
+        """
+        results = {}
+        if not checks:
+            return results
+        table = LineTable(self.lines)
+        self.indent_char = table.indent_char()
+        for name, check, argument_names in checks:
+            for index in table.get(check.table):
+                self.line_number = index + 1
+                self.physical_line = self.lines[index]
+                result = self.run_check(check, argument_names)
+                if result is None:
+                    continue
+                for found in self.check_results(result):
+                    results.setdefault(self.line_number, []).append(
+                        (name, found, check))
+        self.line_number = 0
+        self.indent_char = None
+        return results
+
+    def check_tree(self, results):
+        """
+        Parse the input file once for the tree checks, run them, and add
+        their errors to the results by line number of check_table.
+        """
+        if not self.tree_checks:
+            return
+        import ast
+        lines = self.lines
+        self.tree = self.parse_tree(''.join(lines))
+        if self.tree is None:
+            return
+        self.tree_lines = {}
+        for node in ast.walk(self.tree):
+            if hasattr(node, 'lineno'):
+                self.tree_lines.setdefault(node.lineno, []).append(node)
+        found_lines = {}
+        for name, check, argument_names in self.tree_checks:
+            result = self.run_check(check, argument_names)
+            if result is None:
+                continue
+            if isinstance(result, tuple):
+                result = (result,)
+            check_lines = {}
+            for (line_number, offset), text in result:
+                if self.options.first_only and line_number in check_lines:
+                    continue  # The first error of the check on this line
+                check_lines[line_number] = True
+                if offset and not isinstance(lines[0], bytes):
+                    # The parser counts the columns in UTF-8 bytes
+                    offset = len(lines[line_number - 1].encode('utf-8')
+                                 [:offset].decode('utf-8', 'replace'))
+                results.setdefault(line_number, []).append(
+                    (name, (offset, text), check))
+            found_lines.update(check_lines)
+        for line_number in found_lines:
+            results[line_number].sort(key=lambda result: result[:2])
+        self.tree = self.tree_lines = None
+
+    def parse_tree(self, source):
+        """
+        Return the syntax tree of the source, or None if it does not
+        parse.  Warnings of the compiler are not shown.
+        """
+        import ast
+        import warnings
+        warnings_filters = warnings.filters[:]
+        warnings.simplefilter('ignore')
+        try:
+            try:
+                return ast.parse(source, self.filename)
+            except (SyntaxError, TypeError, ValueError, RuntimeError,
+                    MemoryError):
+                # MemoryError is the overflow of the parser stack
+                return None
+        finally:
+            warnings.filters[:] = warnings_filters
+
+    def check_results(self, result):
+        """
+        Return the errors found by a check which did not return None: an
+        (offset, text) tuple, or an iterable of them.  With --first-only,
+        a check reports only its first error.
+
+        >>> lines = ['foo(bar,baz,qux)\\n', 'a = 4  +  5\\n']
+        >>> StyleGuide(select='E2', repeat=True).input_file('x.py', lines)
+        x.py:1:8: E231 missing whitespace after ','
+        x.py:1:12: E231 missing whitespace after ','
+        x.py:2:6: E221 multiple spaces before operator
+        x.py:2:9: E222 multiple spaces after operator
+        4
+        >>> StyleGuide(select='E2', repeat=True,
+        ...            first_only=True).input_file('x.py', lines)
+        x.py:1:8: E231 missing whitespace after ','
+        x.py:2:6: E221 multiple spaces before operator
+        2
+        """
+        if isinstance(result, tuple):
+            return (result,)
+        if self.options.first_only:
+            for found in result:
+                return (found,)
+            return ()
+        return result
+
+    def new_tokens(self):
+        """
+        Return an empty list for the tokens of a logical line, or a
+        TokenBuffer with --compact-tokens.
+        """
+        if self.options.compact_tokens and not self.streaming:
+            return TokenBuffer(self.lines)
+        return []
 
     def build_tokens_line(self):
         """
         Build a logical line from tokens.
+
+        The offset in the logical line of each token is recorded in
+        mapping_offsets, and the token in mapping_tokens.  The contents
+        of strings are replaced with 'xxx' as the line is joined.
         """
-        self.mapping = []
+        if self.lexer is not None and self.lexer.simple:
+            self.build_simple_line()
+            return
+        self.mapping_offsets = offsets = []
+        self.mapping_tokens = tokens = []
         logical = []
         length = 0
         previous = None
@@ -882,58 +1989,206 @@ class Checker(object):
             token_type, text = token[0:2]
             if token_type in SKIP_TOKENS:
                 continue
-            if token_type == tokenize.STRING:
-                text = mute_string(text)
             if previous:
                 end_line, end = previous[3]
                 start_line, start = token[2]
                 if end_line != start_line:  # different row
-                    prev_text = self.lines[end_line - 1][end - 1]
+                    prev_text = previous[1][-1]
                     if prev_text == ',' or (prev_text not in '{[('
                                             and text not in '}])'):
                         logical.append(' ')
                         length += 1
                 elif end != start:  # different column
-                    fill = self.lines[end_line - 1][end:start]
+                    fill = token[4][end:start]
                     logical.append(fill)
                     length += len(fill)
-            self.mapping.append((length, token))
-            logical.append(text)
+            offsets.append(length)
+            tokens.append(token)
+            if token_type == tokenize.STRING:
+                start, end = string_contents(text)
+                logical.append(text[:start])
+                logical.append('x' * (end - start))
+                logical.append(text[end:])
+            else:
+                logical.append(text)
             length += len(text)
             previous = token
         self.logical_line = ''.join(logical)
         assert self.logical_line.lstrip() == self.logical_line
         assert self.logical_line.rstrip() == self.logical_line
 
+    def build_simple_line(self):
+        """
+        Build the logical line of a statement which the FastLexer found
+        on one line, without strings: it is a slice of that line.
+        """
+        self.mapping_tokens = tokens = [token for token in self.tokens
+                                        if token[0] not in SKIP_TOKENS]
+        start = tokens[0][2][1]
+        self.mapping_offsets = [token[2][1] - start for token in tokens]
+        self.logical_line = tokens[0][4][start:tokens[-1][3][1]]
+
     def check_logical(self):
         """
         Build a line from tokens and run all logical checks on it.
         """
-        options.counters['logical lines'] += 1
-        self.build_tokens_line()
-        first_line = self.lines[self.mapping[0][1][2][0] - 1]
-        indent = first_line[:self.mapping[0][1][2][1]]
-        self.previous_indent_level = self.indent_level
-        self.indent_level = expand_indent(indent)
-        if options.verbose >= 2:
+        self.logical_line_count += 1
+        stages = self.stages
+        if 'logical_line' in stages:
+            self.build_tokens_line()
+        if 'bracket_depth' in stages:
+            self.bracket_depth = BracketDepth(self.logical_line)
+        if 'indent_level' in stages:
+            for token in self.tokens:
+                if token[0] not in SKIP_TOKENS:
+                    break
+            indent = token[4][:token[2][1]]
+            self.previous_indent_level = self.indent_level
+            self.indent_level = expand_indent(indent)
+        if self.options.verbose >= 2:
             print(self.logical_line[:80].rstrip())
-        for name, check, argument_names in options.logical_checks:
-            if options.verbose >= 4:
+        skipped = ()
+        if self.scanner is not None:
+            skipped = self.scanner.skipped(self.logical_line)
+        for name, check, argument_names in self.logical_checks:
+            if name in skipped:
+                continue
+            if self.options.verbose >= 4:
                 print('   ' + name)
-            result = self.run_check(check, argument_names)
-            if result is not None:
-                offset, text = result
+            if argument_names[0] == 'token':
+                results = self.visitor_results.get(name, ())
+            else:
+                results = self.run_check(check, argument_names)
+                if results is None:
+                    continue
+                results = self.check_results(results)
+            for offset, text in results:
                 if isinstance(offset, tuple):
                     original_number, original_offset = offset
                 else:
-                    for token_offset, token in self.mapping:
-                        if offset >= token_offset:
-                            original_number = token[2][0]
-                            original_offset = (token[2][1]
-                                               + offset - token_offset)
+                    original_number, original_offset = \
+                        self.map_offset(offset)
                 self.report_error(original_number, original_offset,
                                   text, check)
-        self.previous_logical = self.logical_line
+        if 'logical_line' in stages:
+            self.previous_logical = self.logical_line
+
+    def start_visitors(self):
+        """
+        Start the token checks on the first token of a logical line, once
+        a token which is not an indent or a dedent shows that the line
+        has statements, and send them the tokens which follow.
+
+        >>> @register_check('W999')
+        ... def first_names(token):
+        ...     names = 0
+        ...     while names < 2:
+        ...         if token[0] == tokenize.NAME:
+        ...             names += 1
+        ...             yield token[2], "W999 name %d" % names
+        ...         token = yield
+        >>> lines = ['if a:\\n', '    b = c + d\\n']
+        >>> errors = StyleGuide(select='W999', repeat=True).input_file(
+        ...     'visit.py', lines)
+        visit.py:1:1: W999 name 1
+        visit.py:1:4: W999 name 2
+        visit.py:2:5: W999 name 1
+        visit.py:2:9: W999 name 2
+        >>> errors = StyleGuide(select='W999', repeat=True,
+        ...                     first_only=True).input_file('visit.py', lines)
+        visit.py:1:1: W999 name 1
+        visit.py:2:5: W999 name 1
+        >>> style = StyleGuide(select='W999', quiet=2, profile_checks=True)
+        >>> errors = style.input_file('visit.py', lines)
+        >>> style.profile.checks['first_names'][0]  # Calls, one per line
+        2
+        >>> del registered_checks['token']['first_names']
+        """
+        tokens = self.tokens
+        self.token = tokens[0]
+        self.visitors = []
+        self.visitor_names = {}
+        self.visitor_results = {}
+        for name, check, argument_names in self.token_checks:
+            if len(argument_names) == 1:
+                send = check(self.token).send
+            else:
+                send = self.run_check(check, argument_names).send
+            self.visitors.append(send)
+            self.visitor_names[send] = name
+        self.visit_token(None)
+        for token in tokens[1:]:
+            if not self.visitors:
+                break
+            self.visit_token(token)
+
+    def visit_token(self, token):
+        """
+        Send a token to the token checks, and collect their results for
+        check_logical.  A check is resumed after each result until it
+        waits for the next token, or stopped with --first-only.
+        """
+        for send in self.visitors:
+            try:
+                result = send(token)
+                while result is not None:
+                    self.visitor_results.setdefault(
+                        self.visitor_names[send], []).append(result)
+                    if self.options.first_only:
+                        break
+                    result = send(None)
+            except StopIteration:
+                result = False
+            if result is not None:
+                self.stop_visitor(send)
+
+    def stop_visitor(self, send):
+        """
+        Stop sending tokens to a token check.
+        """
+        self.visitors = [other for other in self.visitors if other != send]
+
+    def map_offset(self, offset):
+        """
+        Map an offset in the logical line to (line number, offset) in
+        the input file.
+        """
+        index = bisect.bisect_right(self.mapping_offsets, offset) - 1
+        original_number, original_offset = self.mapping_tokens[index][2]
+        return (original_number,
+                original_offset + offset - self.mapping_offsets[index])
+
+    def generate_tokens(self):
+        """
+        Tokenize the input file, checking the physical lines on the way.
+        With --fast-lexer, the simple statements skip tokenize.
+        """
+        if self.options.fast_lexer:
+            self.lexer = FastLexer(self.readline_check_physical)
+            return self.lexer.generate_tokens()
+        return tokenize.generate_tokens(self.readline_check_physical)
+
+    def check_physical_lines(self):
+        """
+        Run the physical checks line by line, without tokenizing.
+        Without line checks, the results of the table checks are
+        reported straight away.
+        """
+        if self.line_checks:
+            while self.readline_check_physical():
+                pass
+            return
+        line_count = len(self.lines)
+        if '' in self.lines:
+            line_count = self.lines.index('')  # readline stops there
+        line_numbers = list(self.table_results.keys())
+        line_numbers.sort()
+        for line_number in line_numbers:
+            if line_number > line_count:
+                break
+            for name, (offset, text), check in \
+                    self.table_results[line_number]:
+                self.report_error(line_number, offset, text, check)
 
     def check_all(self, expected=None, line_offset=0):
         """
@@ -941,17 +2196,73 @@ class Checker(object):
         """
         self.expected = expected or ()
         self.line_offset = line_offset
+        if self.streaming:
+            # The triggers, the tables and the parser would need the
+            # whole file, so the tree checks are skipped
+            self.physical_checks = self.options.physical_checks
+            self.logical_checks = self.options.logical_checks
+            self.tree_checks = []
+        else:
+            (self.physical_checks, self.logical_checks,
+             self.tree_checks) = self.style.select_checks(self.lines)
+        self.line_checks = []
+        table_checks = []
+        for check in self.physical_checks:
+            if getattr(check[1], 'table', None) and not self.streaming:
+                table_checks.append(check)
+            else:
+                self.line_checks.append(check)
+        self.scanner = None
+        self.lexer = None
+        if self.options.fused_scan:
+            self.scanner = fused_scanner(self.logical_checks)
+        self.token_checks = [check for check in self.logical_checks
+                             if check[2][0] == 'token']
+        self.stages = plan_stages(self.logical_checks)
+        if self.options.verbose >= 2:
+            self.stages = ALL_STAGES
+        self.visitors = []
+        self.visitor_names = {}
+        self.visitor_results = {}
         self.line_number = 0
         self.file_errors = 0
+        self.reported_errors = 0
+        self.stopped = False
+        self.logical_line_count = 0
         self.indent_char = None
+        if self.streaming:
+            self.encoding = self.lines.encoding
+        else:
+            self.encoding = source_encoding(self.lines)
+        self.table_results = self.check_table(table_checks)
+        self.check_tree(self.table_results)
         self.indent_level = 0
         self.previous_logical = ''
         self.blank_lines = 0
         self.blank_lines_before_comment = 0
-        self.tokens = []
+        self.tokens = self.new_tokens()
+        try:
+            if 'tokens' in self.stages:
+                self.check_tokens()
+            else:
+                self.check_physical_lines()
+        except StopChecking:
+            self.stopped = True
+            if self.options.fail_fast:
+                raise
+        self.report.increment('logical lines', self.logical_line_count)
+        self.count_streamed_lines()
+        return self.file_errors
+
+    def check_tokens(self):
+        """
+        Tokenize the input file and run the logical checks on each
+        logical line.
+        """
+        track_blank_lines = 'blank_lines' in self.stages
         parens = 0
-        for token in tokenize.generate_tokens(self.readline_check_physical):
-            if options.verbose >= 3:
+        for token in self.generate_tokens():
+            if self.options.verbose >= 3:
                 if token[2][0] == token[3][0]:
                     pos = '[%s:%s]' % (token[2][1] or '', token[3][1])
                 else:
@@ -959,6 +2270,18 @@ class Checker(object):
                 print('l.%s\t%s\t%s\t%r' %
                     (token[2][0], pos, tokenize.tok_name[token[0]], token[1]))
             self.tokens.append(token)
+            if self.token_checks:
+                if len(self.tokens) == 1:
+                    self.visitors = []  # Those of the previous line
+                if self.visitors:
+                    self.visit_token(token)
+                elif (token[0] not in SKIP_TOKENS and
+                      token[0] != tokenize.ENDMARKER and
+                      (len(self.tokens) == 1 or self.tokens[-2][0] in
+                       (tokenize.INDENT, tokenize.DEDENT))):
+                    # Comments, blank lines and the dedents at the end of
+                    # the file do not start a logical line
+                    self.start_visitors()
             token_type, text = token[0:2]
             if token_type == tokenize.OP and text in '([{':
                 parens += 1
@@ -968,98 +2291,1722 @@ class Checker(object):
                 self.check_logical()
                 self.blank_lines = 0
                 self.blank_lines_before_comment = 0
-                self.tokens = []
+                self.tokens = self.new_tokens()
             if token_type == tokenize.NL and not parens:
                 if len(self.tokens) <= 1:
                     # The physical line contains only this token.
                     self.blank_lines += 1
-                self.tokens = []
+                self.tokens = self.new_tokens()
             if token_type == tokenize.COMMENT:
-                source_line = token[4]
-                token_start = token[2][1]
-                if source_line[:token_start].strip() == '':
-                    self.blank_lines_before_comment = max(self.blank_lines,
-                        self.blank_lines_before_comment)
-                    self.blank_lines = 0
+                if track_blank_lines:
+                    source_line = token[4]
+                    token_start = token[2][1]
+                    if source_line[:token_start].strip() == '':
+                        self.blank_lines_before_comment = max(
+                            self.blank_lines, self.blank_lines_before_comment)
+                        self.blank_lines = 0
                 if text.endswith('\n') and not parens:
                     # The comment also ends a physical line.  This works around
                     # Python < 2.6 behaviour, which does not generate NL after
                     # a comment which is on a line by itself.
-                    self.tokens = []
+                    self.tokens = self.new_tokens()
+
+    def count_streamed_lines(self):
+        """
+        Count the physical lines of a streamed file, once they are read.
+        """
+        if self.streaming:
+            self.report.increment('physical lines', len(self.lines))
+
+    def replay(self, results, checks):
+        """
+        Report errors recorded by another Checker.
+        The checks argument maps check names to check functions.
+        """
+        self.expected = ()
+        self.line_offset = 0
+        self.file_errors = 0
+        self.reported_errors = 0
+        try:
+            for line_number, offset, text, name in results:
+                self.report_error(line_number, offset, text, checks[name])
+        except StopChecking:
+            if self.options.fail_fast:
+                raise
         return self.file_errors
 
     def report_error(self, line_number, offset, text, check):
         """
-        Report an error, according to options.
+        Report an error, according to options.  Raise StopChecking when
+        the error limit of the file is reached.
         """
         code = text[:4]
-        if ignore_code(code):
+        if self.style.ignore_code(code):
             return
-        if options.quiet == 1 and not self.file_errors:
-            message(self.filename)
-        if code in options.counters:
-            options.counters[code] += 1
-        else:
-            options.counters[code] = 1
-            options.messages[code] = text[5:]
-        if options.quiet or code in self.expected:
+        if self.encoding and offset:
+            offset = self.char_offset(line_number, offset)
+        if self.results is not None:
+            self.results.append((line_number, offset, text, check.__name__))
+        options = self.options
+        self.reported_errors += 1
+        if options.quiet == 1 and self.reported_errors == 1:
+            self.report.write([self.filename])
+        count = self.report.count_error(code, text)
+        if not options.quiet and code not in self.expected:
             # Don't care about expected errors or warnings
-            return
-        self.file_errors += 1
-        if options.counters[code] == 1 or options.repeat:
-            message("%s:%s:%d: %s" %
-                    (self.filename, self.line_offset + line_number,
-                     offset + 1, text))
-            if options.show_source:
-                line = self.lines[line_number - 1]
-                message(line.rstrip())
-                message(' ' * offset + '^')
-            if options.show_pep8:
-                message(check.__doc__.lstrip('\n').rstrip())
-
+            self.file_errors += 1
+            if count == 1 or options.repeat:
+                output = ["%s:%s:%d: %s" %
+                          (self.filename, self.line_offset + line_number,
+                           offset + 1, text)]
+                if options.show_source:
+                    try:
+                        line = self.lines[line_number - 1]
+                    except (IndexError, KeyError):
+                        line = None  # Out of the window of a streamed file
+                    if line is not None:
+                        output.append(line.rstrip())
+                        output.append(' ' * offset + '^')
+                if options.show_pep8:
+                    output.append(check.__doc__.lstrip('\n').rstrip())
+                self.report.write(output)
+        if self.reported_errors == self.error_limit:
+            raise StopChecking()
+
+    def char_offset(self, line_number, offset):
+        """
+        Convert an offset in the raw bytes of a line to characters.
+        """
+        try:
+            line = self.lines[line_number - 1][:offset]
+        except IndexError:
+            return offset
+        return len(line.decode(self.encoding, 'replace'))
+
+
+class ProfilingChecker(Checker):
+    """
+    Checker which times the stages of the framework for --profile-checks:
+    the tokenizer, the physical checks, the table checks, the parser of
+    the tree checks, build_tokens_line and map_offset.
+    The checks themselves are timed by CheckProfile.wrap.
+    """
+
+    def __init__(self, filename, lines=None, style=None):
+        Checker.__init__(self, filename, lines, style)
+        self.profile = self.style.profile
+        self.physical_time = 0.0
+
+    def generate_tokens(self):
+        tokens = iter(Checker.generate_tokens(self))
+        while True:
+            physical_time = self.physical_time
+            start = timer()
+            try:
+                token = next(tokens)
+            except StopIteration:
+                break
+            # The tokenizer calls check_physical through readline
+            self.profile.add_stage('tokenize', timer() - start -
+                                   (self.physical_time - physical_time))
+            yield token
+
+    def check_physical(self, line):
+        start = timer()
+        Checker.check_physical(self, line)
+        elapsed = timer() - start
+        self.physical_time += elapsed
+        self.profile.add_stage('check_physical', elapsed)
+
+    def check_table(self, checks):
+        start = timer()
+        results = Checker.check_table(self, checks)
+        self.profile.add_stage('check_table', timer() - start)
+        return results
+
+    def parse_tree(self, source):
+        start = timer()
+        tree = Checker.parse_tree(self, source)
+        self.profile.add_stage('parse_tree', timer() - start)
+        return tree
+
+    def build_tokens_line(self):
+        start = timer()
+        Checker.build_tokens_line(self)
+        self.profile.add_stage('build_tokens_line', timer() - start)
+
+    def map_offset(self, offset):
+        start = timer()
+        result = Checker.map_offset(self, offset)
+        self.profile.add_stage('map_offset', timer() - start)
+        return result
+
+
+class CheckProfile(object):
+    """
+    Calls, time and hits (results other than None) of each check, and
+    calls and time of the stages of the framework, for --profile-checks.
+
+    Only the checks wrapped by this profile are timed, so a run without
+    --profile-checks has no overhead at all.
+    """
+
+    def __init__(self):
+        self.checks = {}  # name: [calls, seconds, hits]
+        self.stages = {}  # name: [calls, seconds]
 
-def input_file(filename):
+    def wrap(self, checks):
+        """
+        Return a copy of a list of checks, where each check is timed.
+        """
+        wrapped = []
+        for name, check, argument_names in checks:
+            if argument_names[0] == 'token':
+                timed_check = self.timed_visitor(name, check)
+            else:
+                timed_check = self.timed(name, check)
+            wrapped.append((name, timed_check, argument_names))
+        return wrapped
+
+    def timed(self, name, check):
+        stats = self.checks.setdefault(name, [0, 0.0, 0])
+
+        def timed_check(*arguments):
+            start = timer()
+            result = check(*arguments)
+            if result is not None and not isinstance(result, tuple):
+                result = list(result)  # Run a generator check here
+            stats[1] += timer() - start
+            stats[0] += 1
+            if isinstance(result, tuple):
+                stats[2] += 1
+            elif result:
+                stats[2] += len(result)
+            return result
+        timed_check.__name__ = check.__name__
+        timed_check.__doc__ = check.__doc__
+        timed_check.__dict__.update(check.__dict__)
+        return timed_check
+
+    def timed_visitor(self, name, check):
+        """
+        Time a token check: a call is one logical line, and the time
+        adds up the tokens sent to it.
+        """
+        stats = self.checks.setdefault(name, [0, 0.0, 0])
+
+        def timed_check(*arguments):
+            stats[0] += 1
+            visitor = check(*arguments)
+            token = None
+            while True:
+                start = timer()
+                try:
+                    result = visitor.send(token)
+                except StopIteration:
+                    stats[1] += timer() - start
+                    return
+                stats[1] += timer() - start
+                if result is not None:
+                    stats[2] += 1
+                token = yield result
+        timed_check.__name__ = check.__name__
+        timed_check.__doc__ = check.__doc__
+        timed_check.__dict__.update(check.__dict__)
+        return timed_check
+
+    def add_stage(self, name, seconds):
+        stats = self.stages.setdefault(name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+    def take(self):
+        """
+        Return the numbers collected so far, and start again from zero.
+        """
+        taken = {'checks': {}, 'stages': {}}
+        for kind in taken:
+            for name, stats in getattr(self, kind).items():
+                taken[kind][name] = stats[:]
+                for index in range(len(stats)):
+                    stats[index] = 0
+        return taken
+
+    def merge(self, taken):
+        """
+        Add the numbers returned by take in another process.
+        """
+        for kind in taken:
+            profile = getattr(self, kind)
+            for name, stats in taken[kind].items():
+                if name in profile:
+                    for index in range(len(stats)):
+                        profile[name][index] += stats[index]
+                else:
+                    profile[name] = stats
+
+    def get_table(self):
+        """
+        Return rows (kind, name, calls, seconds, mean seconds, hits),
+        sorted by decreasing time.
+        """
+        rows = []
+        for name, (calls, seconds, hits) in self.checks.items():
+            rows.append(('check', name, calls, seconds,
+                         calls and seconds / calls, hits))
+        for name, (calls, seconds) in self.stages.items():
+            rows.append(('stage', name, calls, seconds,
+                         calls and seconds / calls, None))
+        rows.sort(key=lambda row: (-row[3], row[1]))
+        return rows
+
+    def print_table(self):
+        print('%-8s %-40s %9s %9s %9s %7s' %
+              ('kind', 'name', 'calls', 'total s', 'mean us', 'hits'))
+        for kind, name, calls, seconds, mean, hits in self.get_table():
+            if hits is None:
+                hits = '-'
+            print('%-8s %-40s %9d %9.4f %9.2f %7s' %
+                  (kind, name, calls, seconds, mean * 1e6, hits))
+
+    def write_json(self, filename):
+        import json
+        rows = []
+        for kind, name, calls, seconds, mean, hits in self.get_table():
+            rows.append({'kind': kind, 'name': name, 'calls': calls,
+                         'seconds': seconds, 'mean': mean, 'hits': hits})
+        output = open(filename, 'w')
+        try:
+            json.dump(rows, output, indent=1)
+        finally:
+            output.close()
+
+
+class Report(object):
+    """
+    Count the errors found by the Checkers of a style guide, and print
+    them.  The methods can be called from several threads at once.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.counters = dict.fromkeys(BENCHMARK_KEYS, 0)
+        self.messages = {}
+        self.lock = threading.Lock()
+
+    def increment(self, key, count=1):
+        """
+        Add to one of the BENCHMARK_KEYS counters.
+        """
+        self.lock.acquire()
+        try:
+            self.counters[key] += count
+        finally:
+            self.lock.release()
+
+    def count_error(self, code, text):
+        """
+        Count an error and return how many times its code was found.
+        """
+        self.lock.acquire()
+        try:
+            if code in self.counters:
+                self.counters[code] += 1
+            else:
+                self.counters[code] = 1
+                self.messages[code] = text[5:]
+            return self.counters[code]
+        finally:
+            self.lock.release()
+
+    def write(self, lines):
+        """
+        Print lines of output, without mixing them with the output of
+        other threads.
+        """
+        self.lock.acquire()
+        try:
+            for line in lines:
+                message(line)
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        """
+        Forget the errors found so far, but not the BENCHMARK_KEYS.
+        """
+        self.lock.acquire()
+        try:
+            for key in list(self.counters.keys()):
+                if key not in BENCHMARK_KEYS:
+                    del self.counters[key]
+            self.messages.clear()
+        finally:
+            self.lock.release()
+
+    def get_statistics(self, prefix=''):
+        """
+        Get statistics for message codes that start with the prefix.
+
+        prefix='' matches all errors and warnings
+        prefix='E' matches all errors
+        prefix='W' matches all warnings
+        prefix='E4' matches all errors that have to do with imports
+        """
+        stats = []
+        keys = list(self.messages.keys())
+        keys.sort()
+        for key in keys:
+            if key.startswith(prefix):
+                stats.append('%-7s %s %s' %
+                             (self.counters[key], key, self.messages[key]))
+        return stats
+
+    def get_count(self, prefix=''):
+        """Return the total count of errors and warnings."""
+        keys = list(self.messages.keys())
+        count = 0
+        for key in keys:
+            if key.startswith(prefix):
+                count += self.counters[key]
+        return count
+
+    def print_statistics(self, prefix=''):
+        """Print overall statistics (number of errors and warnings)."""
+        for line in self.get_statistics(prefix):
+            print(line)
+
+    def print_benchmark(self, elapsed):
+        """
+        Print benchmark numbers.
+        """
+        print('%-7.2f %s' % (elapsed, 'seconds elapsed'))
+        for key in BENCHMARK_KEYS:
+            print('%-7d %s per second (%d total)' % (
+                self.counters[key] / elapsed, key,
+                self.counters[key]))
+
+
+class StyleGuide(object):
+    """
+    A configured style guide: the options, the checks they enable and
+    the report of the errors found.
+
+    The options are those of the command line, either as an
+    optparse.Values object or as keyword arguments, for example
+    StyleGuide(select='E,W6', repeat=True).  Each instance owns its
+    configuration, a copy of the options which holds its check lists
+    and counters, so differently configured style guides can be used in
+    the same process, even from the same options.  A style guide can
+    check files from several threads at once: each file gets its own
+    Checker, and the report serializes the counters and the output.
+
+    >>> options = get_parser().get_default_values()
+    >>> first = StyleGuide(options)
+    >>> second = StyleGuide(options, select='E501')
+    >>> [check[0] for check in second.options.physical_checks]
+    ['maximum_line_length']
+    >>> options.select, first.options.select, second.options.select
+    ('', [], ['E501'])
+    """
+
+    def __init__(self, options=None, **kwargs):
+        if options is None:
+            options = get_parser().get_default_values()
+        else:
+            import copy
+            options = copy.copy(options)  # Leave the caller's untouched
+        for name, value in kwargs.items():
+            setattr(options, name, value)
+        self.options = options
+        self.init_options()
+        self.report = Report(options)
+        options.counters = self.report.counters
+        options.messages = self.report.messages
+        self.exclude_matcher = PathMatcher(options.exclude)
+        self.filename_matcher = PathMatcher(options.filename)
+        self.ignored_codes = {}
+        (options.physical_checks, options.logical_checks,
+         options.tree_checks) = self.init_checks()
+        self.enabled_codes = self.init_codes()
+        if options.max_errors_per_file or options.fail_fast:
+            options.logical_checks = first_checks(options.logical_checks)
+        self.triggers = self.check_triggers()
+        self.checker_class = Checker
+        self.profile = None
+        if options.profile_checks or options.profile_json:
+            profile = self.profile = CheckProfile()
+            options.physical_checks = profile.wrap(options.physical_checks)
+            options.logical_checks = profile.wrap(options.logical_checks)
+            options.tree_checks = profile.wrap(options.tree_checks)
+            self.checker_class = ProfilingChecker
+        options.cache_fingerprint = None
+        if options.cache_dir:
+            if not os.path.isdir(options.cache_dir):
+                os.makedirs(options.cache_dir)
+            options.cache_fingerprint = self.fingerprint()
+        elif memory_cache is not None:
+            options.cache_fingerprint = self.fingerprint()
+
+    def init_options(self):
+        """
+        Turn the comma separated option values into lists.
+        """
+        options = self.options
+        if not hasattr(options, 'prog'):
+            options.prog = 'pep8'
+        if isinstance(options.exclude, str):
+            options.exclude = options.exclude.split(',')
+        if isinstance(options.filename, str):
+            options.filename = options.filename and \
+                options.filename.split(',') or []
+        if isinstance(options.select, str):
+            options.select = options.select and \
+                options.select.split(',') or []
+        if not isinstance(options.ignore, str):
+            pass
+        elif options.ignore:
+            options.ignore = options.ignore.split(',')
+        elif options.select:
+            # Ignore all checks which are not explicitly selected
+            options.ignore = ['']
+        elif options.testsuite or options.doctest:
+            # For doctest and testsuite, all checks are required
+            options.ignore = []
+        else:
+            # The default choice: ignore controversial checks
+            options.ignore = DEFAULT_IGNORE.split(',')
+
+    def init_checks(self):
+        """
+        Return the lists of physical, logical and tree checks enabled by
+        the options.  A --server reuses them for the same options.
+        """
+        plan_key = (tuple(self.options.select), tuple(self.options.ignore))
+        if check_plans is not None and plan_key in check_plans:
+            return check_plans[plan_key]
+        logical_checks = (self.find_checks('logical_line') +
+                          self.find_checks('token'))
+        logical_checks.sort()
+        plan = (self.find_checks('physical_line'), logical_checks,
+                self.find_checks('tree'))
+        if check_plans is not None:
+            check_plans[plan_key] = plan
+        return plan
+
+    def init_codes(self):
+        """
+        Decide once which codes of the enabled checks are ignored, and
+        return the set of those which are not.  The decisions serve
+        ignore_code, which decides the other codes on first use.
+        """
+        enabled = {}
+        for name, check, argument_names in (self.options.physical_checks +
+                                            self.options.logical_checks +
+                                            self.options.tree_checks):
+            for code in check.codes:
+                if not self.ignore_code(code):
+                    enabled[code] = True
+        return frozenset(enabled)
+
+    def find_checks(self, argument_name):
+        """
+        Find all registered checks where the first argument name starts
+        with argument_name, and which report some code not ignored.
+        """
+        checks = []
+        for kind, kind_checks in registered_checks.items():
+            if not kind.startswith(argument_name):
+                continue
+            for name, (check, argument_names) in kind_checks.items():
+                for code in check.codes or ('',):
+                    if not code or not self.ignore_code(code):
+                        checks.append((name, check, argument_names))
+                        break
+        checks.sort()
+        return checks
+
+    def check_triggers(self):
+        """
+        Return the triggers declared by the enabled checks.
+
+        A check may have a 'triggers' attribute: a tuple of characters
+        or substrings, at least one of which must occur in the source
+        file for the check to return anything.
+        """
+        triggers = {}
+        for name, check, argument_names in (self.options.physical_checks +
+                                            self.options.logical_checks +
+                                            self.options.tree_checks):
+            for trigger in getattr(check, 'triggers', ()):
+                triggers[trigger] = True
+        return sorted(triggers)
+
+    def select_checks(self, lines):
+        """
+        Return the physical, logical and tree checks to run on a source
+        file.  The file is scanned once for the triggers of the checks,
+        and the checks whose triggers are all absent are left out.
+        """
+        physical_checks = self.options.physical_checks
+        logical_checks = self.options.logical_checks
+        tree_checks = self.options.tree_checks
+        if not self.triggers:
+            return physical_checks, logical_checks, tree_checks
+        source = ''.join(lines)
+        absent = {}
+        for trigger in self.triggers:
+            if trigger not in source:
+                absent[trigger] = True
+        if not absent:
+            return physical_checks, logical_checks, tree_checks
+        return (skip_checks(physical_checks, absent),
+                skip_checks(logical_checks, absent),
+                skip_checks(tree_checks, absent))
+
+    def check_functions(self):
+        """
+        Map the names of the enabled checks to the check functions.
+        """
+        checks = {}
+        for name, check, argument_names in (self.options.physical_checks +
+                                            self.options.logical_checks +
+                                            self.options.tree_checks):
+            checks[name] = check
+        return checks
+
+    def ignore_code(self, code):
+        """
+        Check if options.ignore contains a prefix of the error code.
+        If options.select contains a prefix of the error code, do not ignore
+        it.  The decision is looked up in a table after the first time.
+        """
+        try:
+            return self.ignored_codes[code]
+        except KeyError:
+            pass
+        ignored = False
+        for select in self.options.select:
+            if code.startswith(select):
+                break
+        else:
+            for ignore in self.options.ignore:
+                if code.startswith(ignore):
+                    ignored = True
+                    break
+        self.ignored_codes[code] = ignored
+        return ignored
+
+    def excluded(self, filename, is_dir=False, root=None):
+        """
+        Check if options.exclude matches filename or one of its parent
+        directories below root.  By default, filename is the root of the
+        checked tree, and only its name is matched.
+        """
+        path = normalize_path(filename)
+        if root is None:
+            root = path[:path.rfind('/') + 1]
+        return self.exclude_matcher.excluded(path, is_dir, root)
+
+    def filename_match(self, filename):
+        """
+        Check if options.filename matches filename.
+        If options.filename is unspecified, this always returns True.
+        """
+        if not self.options.filename:
+            return True
+        return self.filename_matcher.match(normalize_path(filename)) or False
+
+    def check_files(self, paths, runner=None, sources=None):
+        """
+        Check files and directories, and return the report.
+
+        The sources argument maps file names to source code to check in
+        place of the files.  With options.jobs > 1 and no runner, the
+        files are checked in parallel processes.  A file or a directory
+        given twice, or within another one, is checked and counted once.
+        """
+        parallel = runner is None and self.options.jobs > 1
+        if parallel:
+            pending = []
+            runner = pending.append
+        elif runner is None:
+            runner = self.input_file
+        seen = {}
+        try:
+            for path in paths:
+                if os.path.abspath(path) in seen:
+                    continue
+                if sources and path in sources:
+                    seen[os.path.abspath(path)] = True
+                    self.report.increment('files')
+                    self.input_file(path, sources[path].splitlines(True))
+                elif os.path.isdir(path):
+                    self.input_dir(path, runner=runner, seen=seen)
+                elif not self.excluded(path):
+                    seen[os.path.abspath(path)] = True
+                    self.report.increment('files')
+                    runner(path)
+            if parallel:
+                self.input_files_parallel(pending)
+        except StopChecking:
+            pass  # --fail-fast found an error: the exit status is decided
+        if self.options.cache_dir:
+            self.prune_cache()
+        return self.report
+
+    def input_file(self, filename, lines=None):
+        """
+        Run all checks on a Python source file.
+        """
+        if self.options.verbose:
+            self.report.write(['checking ' + filename])
+        checker = self.checker_class(filename, lines, self)
+        if not self.options.cache_fingerprint or checker.streaming:
+            return checker.check_all()
+        return self.check_cached(checker, self.cache_key(checker.lines))
+
+    def input_dir(self, dirname, runner=None, seen=None):
+        """
+        Check all Python source files in this directory and all
+        subdirectories.  The seen argument maps the identities of the
+        directories and the absolute paths of the files already
+        checked, which are skipped.
+        """
+        dirname = dirname.rstrip('/')
+        if self.excluded(dirname, True):
+            return
+        if runner is None:
+            runner = self.input_file
+        if seen is None:
+            seen = {}
+        for root, filenames in self.walk_dir(dirname, seen):
+            if self.options.verbose:
+                self.report.write(['directory ' + root])
+            self.report.increment('directories')
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if os.path.abspath(path) in seen:
+                    continue
+                seen[os.path.abspath(path)] = True
+                self.report.increment('files')
+                runner(path)
+
+    def walk_dir(self, dirname, seen):
+        """
+        Generate the directories under dirname with the names of their
+        Python source files, in the order of a sorted os.walk.  The
+        threads of a DirectoryLister list the tree ahead of the checks,
+        and prune the excluded directories.  Symbolic links to
+        directories are not followed.
+
+        >>> import shutil, tempfile
+        >>> tree = tempfile.mkdtemp()
+        >>> for name in ['b/e.py', 'a/z.py', 'a/c/d.py', 'b.py', 'a.txt']:
+        ...     path = os.path.join(tree, name)
+        ...     if not os.path.isdir(os.path.dirname(path)):
+        ...         os.makedirs(os.path.dirname(path))
+        ...     open(path, 'w').close()
+        >>> style = StyleGuide(quiet=True)
+        >>> walked = list(style.walk_dir(tree, {}))
+        >>> expected = []
+        >>> for root, dirs, files in os.walk(tree):
+        ...     dirs.sort()
+        ...     expected.append((root, sorted(name for name in files
+        ...                                   if name.endswith('.py'))))
+        >>> walked == expected
+        True
+        >>> [os.path.relpath(root, tree) for root, files in walked]
+        ['.', 'a', 'a/c', 'b']
+        >>> paths = [os.path.join(tree, 'a'), tree, os.path.join(tree, 'b.py')]
+        >>> style.check_files(paths).counters['files']
+        4
+        >>> shutil.rmtree(tree)
+        """
+        lister = DirectoryLister(self.select_entries)
+        try:
+            lister.request([(dirname, ('', [self.exclude_matcher]))])
+            stack = [dirname]
+            while stack:
+                root = stack.pop()
+                try:
+                    identity, subdirs, filenames = lister.get(root)
+                except OSError:
+                    continue  # Like os.walk, skip unreadable directories
+                if identity in seen:
+                    continue
+                seen[identity] = True
+                stack.extend(subdirs)
+                yield root, filenames
+        finally:
+            lister.close()
+
+    def select_entries(self, path, context, dirs, files):
+        """
+        Return the subdirectories of a directory which are not excluded,
+        each with its context, and its Python source files.  The context
+        is the path relative to the checked directory and the matchers
+        of the exclude patterns: those of the .gitignore files found on
+        the way with --gitignore, then those of options.exclude.
+        """
+        relative, matchers = context
+        if self.options.gitignore and '.gitignore' in files:
+            ignored = read_gitignore(os.path.join(path, '.gitignore'),
+                                     relative)
+            matchers = matchers[:-1] + [ignored] + matchers[-1:]
+        prefix = relative and relative + '/'
+        subdirs = []
+        for name in dirs:
+            if not excluded_by(matchers, prefix + name, True):
+                subdirs.append((os.path.join(path, name),
+                                (prefix + name, matchers)))
+        filenames = [name for name in files
+                     if self.filename_match(prefix + name) and
+                     not excluded_by(matchers, prefix + name)]
+        return subdirs, filenames
+
+    def check_cached(self, checker, key, entry=None):
+        """
+        Run all checks and store the results in the cache, or replay the
+        results cached for this key.
+        """
+        if entry is None:
+            entry = self.cache_load(key)
+        if entry is not None:
+            physical_lines, logical_lines, results = entry
+            self.report.increment('logical lines', logical_lines)
+            return checker.replay(results, self.check_functions())
+        checker.results = []
+        errors = checker.check_all()
+        if not checker.stopped:
+            # The results of a file cut short are incomplete
+            self.cache_store(key, len(checker.lines),
+                             checker.logical_line_count, checker.results)
+        return errors
+
+    def check_file_results(self, filename):
+        """
+        Run all checks on a Python source file and return what they found,
+        without reporting anything.  This is the unit of work of --jobs.
+
+        The result is a tuple (filename, physical lines, logical lines,
+        errors, source), where errors is a list of (line_number, offset,
+        text, check name) and source maps the line indexes of those errors
+        to the raw lines (only with --show-source).
+        """
+        checker = self.checker_class(filename, None, self)
+        entry = None
+        cached = self.options.cache_fingerprint and not checker.streaming
+        if cached:
+            key = self.cache_key(checker.lines)
+            entry = self.cache_load(key)
+        if entry is None:
+            checker.results = []
+            try:
+                checker.check_all()
+            except StopChecking:
+                pass  # The parent process stops the run with --fail-fast
+            entry = (len(checker.lines), checker.logical_line_count,
+                     checker.results)
+            if cached and not checker.stopped:
+                self.cache_store(key, *entry)
+        physical_lines, logical_lines, results = entry
+        source = {}
+        if self.options.show_source:
+            for result in results:
+                try:
+                    source[result[0] - 1] = checker.lines[result[0] - 1]
+                except IndexError:
+                    pass  # Out of the window of a streamed file
+        return (filename, physical_lines, logical_lines, results, source)
+
+    def input_files_parallel(self, filenames):
+        """
+        Check many files in a pool of options.jobs worker processes.
+
+        The errors are reported in this process, in the order of a
+        sequential run, so that the output, statistics, --count and the
+        first occurrence rule of non --repeat output are the same.  With
+        --fail-fast, the first batch with errors cancels the batches still
+        pending.
+        """
+        import copy
+        import multiprocessing
+        checks = self.check_functions()
+        found = {}
+        # The workers build their own check lists: those of --profile-checks
+        # hold closures, which the spawn start method cannot pickle
+        worker_options = copy.copy(self.options)
+        for name in ('physical_checks', 'logical_checks', 'tree_checks'):
+            delattr(worker_options, name)
+        pool = multiprocessing.Pool(self.options.jobs, _init_worker,
+                                    (worker_options,))
+        try:
+            for batch, profile in pool.imap_unordered(
+                    _check_batch, make_batches(filenames, self.options.jobs)):
+                for result in batch:
+                    found[result[0]] = result
+                if profile is not None:
+                    self.profile.merge(profile)
+                if self.options.fail_fast and \
+                   [result for result in batch if result[3]]:
+                    break
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        for filename in filenames:
+            if filename not in found:
+                continue  # Cancelled by --fail-fast
+            filename, physical_lines, logical_lines, results, source = \
+                found[filename]
+            if self.options.verbose:
+                self.report.write(['checking ' + filename])
+            self.report.increment('physical lines', physical_lines)
+            self.report.increment('logical lines', logical_lines)
+            checker = Checker(filename, [], self)
+            checker.lines = source
+            checker.replay(results, checks)
+
+    def fingerprint(self):
+        """
+        Hash the options which affect the results of the checks.
+        """
+        options = self.options
+        fingerprint = repr((__version__, MAX_LINE_LENGTH,
+                            options.select, options.ignore,
+                            options.first_only,
+                            [check[0] for check in options.physical_checks],
+                            [check[0] for check in options.logical_checks],
+                            [check[0] for check in options.tree_checks]))
+        if options.tree_checks:
+            # Which files parse depends on the version of Python
+            fingerprint += repr(sys.version_info[:2])
+        return sha1_hex(fingerprint)
+
+    def cache_key(self, lines):
+        """
+        Return the cache key for a file: its content plus the fingerprint
+        of the options.
+        """
+        return sha1_hex(self.options.cache_fingerprint + ''.join(lines))
+
+    def cache_load(self, key):
+        """
+        Return (physical lines, logical lines, errors) cached for this key,
+        or None.  A hit marks the entry as recently used.
+        """
+        if memory_cache is not None:
+            entry = memory_cache.get(key)
+            if entry is not None:
+                return entry
+        if not self.options.cache_dir:
+            return None
+        import json
+        path = os.path.join(self.options.cache_dir, key)
+        try:
+            cache_file = open(path)
+            try:
+                entry = json.load(cache_file)
+            finally:
+                cache_file.close()
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return (entry['physical lines'], entry['logical lines'],
+                entry['errors'])
+
+    def cache_store(self, key, physical_lines, logical_lines, results):
+        """
+        Store the results of a file in the cache.  The entry is written to
+        a temporary file first and then renamed, so that concurrent runs
+        never see a partial entry.
+        """
+        if memory_cache is not None:
+            memory_cache.store(key, (physical_lines, logical_lines, results),
+                               self.options.cache_size)
+        if not self.options.cache_dir:
+            return
+        import json
+        import tempfile
+        cache_dir = self.options.cache_dir
+        entry = {'physical lines': physical_lines,
+                 'logical lines': logical_lines, 'errors': results}
+        try:
+            handle, temp_path = tempfile.mkstemp(prefix='.tmp-',
+                                                 dir=cache_dir)
+            cache_file = os.fdopen(handle, 'w')
+            try:
+                json.dump(entry, cache_file)
+            finally:
+                cache_file.close()
+            getattr(os, 'replace', os.rename)(temp_path,
+                                              os.path.join(cache_dir, key))
+        except (IOError, OSError):
+            pass
+
+    def prune_cache(self):
+        """
+        Evict the least recently used entries while the cache holds more
+        than options.cache_size files.  Temporary files left behind by
+        interrupted runs are removed after an hour.
+        """
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.options.cache_dir):
+            path = os.path.join(self.options.cache_dir, name)
+            try:
+                mtime = os.path.getmtime(path)
+                if not name.startswith('.'):
+                    entries.append((mtime, path))
+                elif now - mtime > 3600:
+                    os.remove(path)
+            except OSError:
+                pass  # Removed by a concurrent run
+        entries.sort()
+        for mtime, path in entries[:len(entries) - self.options.cache_size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def git_changed_files(self, revisions=None, paths=()):
+        """
+        Return (filename, blob) for the Python files changed between two
+        revisions ('rev1..rev2'), or staged in the index if revisions is
+        None.  The blob is the SHA-1 of the new content.
+        """
+        arguments = ['diff', '--raw', '-z', '--no-abbrev', '--no-renames',
+                     '--diff-filter=ACM']
+        if revisions is None:
+            arguments.append('--cached')
+        else:
+            arguments.append(revisions)
+        arguments.append('--')
+        arguments.extend(paths)
+        fields = git(*arguments).split('\0')
+        cdup = git('rev-parse', '--show-cdup').strip()
+        changed = []
+        for index in range(0, len(fields) - 1, 2):
+            old_mode, new_mode, old_blob, blob, status = \
+                fields[index].split()
+            path = fields[index + 1]
+            if new_mode not in ('100644', '100755'):
+                continue  # Symbolic link or submodule
+            if (self.filename_match(path) and
+                    not self.excluded(path, root='')):
+                changed.append((os.path.normpath(os.path.join(cdup, path)),
+                                blob))
+        return changed
+
+    def input_git(self, revisions=None, paths=()):
+        """
+        Check the Python files changed between two revisions, or staged in
+        the index, reading their content straight from git.  With
+        --cache-dir, the blob SHA-1 is the cache key, so blobs checked
+        before are not even read.
+        """
+        reader = GitBlobReader()
+        try:
+            for filename, blob in self.git_changed_files(revisions, paths):
+                self.report.increment('files')
+                if self.options.verbose:
+                    self.report.write(['checking ' + filename])
+                if not self.options.cache_fingerprint:
+                    self.checker_class(filename, reader.read(blob),
+                                       self).check_all()
+                    continue
+                key = sha1_hex(self.options.cache_fingerprint + 'blob ' + blob)
+                entry = self.cache_load(key)
+                if entry is not None and not self.options.show_source:
+                    self.report.increment('physical lines', entry[0])
+                    self.report.increment('logical lines', entry[1])
+                    Checker(filename, [], self).replay(entry[2],
+                                                       self.check_functions())
+                    continue
+                checker = self.checker_class(filename, reader.read(blob),
+                                             self)
+                self.check_cached(checker, key, entry)
+        finally:
+            reader.close()
+
+
+def skip_checks(checks, absent):
+    """
+    Return the checks which have no triggers, or some triggers which
+    are not absent.
+    """
+    selected = []
+    for check in checks:
+        triggers = getattr(check[1], 'triggers', None)
+        if triggers:
+            for trigger in triggers:
+                if trigger not in absent:
+                    break
+            else:
+                continue
+        selected.append(check)
+    return selected
+
+
+def first_checks(checks):
+    """
+    Return the checks in the order of FIRST_CHECKS, so that an error
+    limit is reached as soon as possible.  Other checks come last, in
+    name order.
+    """
+    order = {}
+    for index, name in enumerate(FIRST_CHECKS):
+        order[name] = index
+    ranked = [(order.get(check[0], len(order)), check) for check in checks]
+    ranked.sort()
+    return [check for rank, check in ranked]
+
+
+class DirectoryLister(object):
+    """
+    A pool of threads which list a tree of directories.  The select
+    function, called with a directory, its context and the names in its
+    listing, returns the subdirectories to list with their context, and
+    the files to keep.  The directories requested last are listed first,
+    which suits the depth first order of StyleGuide.walk_dir.
+    """
+
+    def __init__(self, select, threads=WALK_THREADS):
+        self.select = select
+        lock = threading.Lock()
+        self.requested = threading.Condition(lock)
+        self.listed = threading.Condition(lock)
+        self.requests = []
+        self.listings = {}
+        self.closed = False
+        for index in range(threads):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def request(self, directories):
+        """
+        Queue (path, context) pairs of directories to list, the last one
+        first.
+        """
+        self.requested.acquire()
+        try:
+            self.requests.extend(directories)
+            self.requested.notify(len(directories))
+        finally:
+            self.requested.release()
+
+    def get(self, path):
+        """
+        Wait for the listing of a requested directory, and return its
+        identity, the paths of the selected subdirectories in reverse
+        order and the selected file names, or raise the error of
+        list_directory or of the select function.
+        """
+        self.listed.acquire()
+        try:
+            while path not in self.listings:
+                self.listed.wait()
+            listing, error = self.listings.pop(path)
+        finally:
+            self.listed.release()
+        if error is not None:
+            raise error
+        return listing
+
+    def work(self):
+        """
+        List the requested directories until the lister is closed.
+        """
+        self.requested.acquire()
+        held = True
+        try:
+            while not self.closed:
+                if not self.requests:
+                    self.requested.wait()
+                    continue
+                path, context = self.requests.pop()
+                self.requested.release()
+                held = False
+                subdirs = []
+                try:
+                    identity, dirs, files = list_directory(path)
+                    subdirs, files = self.select(path, context, dirs, files)
+                    subdirs.reverse()
+                    paths = [subdir[0] for subdir in subdirs]
+                    result = ((identity, paths, files), None)
+                except Exception:
+                    # Raised by get() in the thread which waits for it
+                    result = (None, sys.exc_info()[1])
+                self.requested.acquire()
+                held = True
+                self.listings[path] = result
+                self.listed.notify()
+                self.requests.extend(subdirs)
+                self.requested.notify(len(subdirs))
+        finally:
+            if held:
+                self.requested.release()
+
+    def close(self):
+        """
+        Stop the threads once they are done with their directory.
+        """
+        self.requested.acquire()
+        try:
+            self.closed = True
+            self.requests = []
+            self.requested.notify_all()
+        finally:
+            self.requested.release()
+
+
+class PathMatcher(object):
+    """
+    Path patterns in the syntax of .gitignore, compiled into regular
+    expressions.  A pattern without a slash matches a name at any depth,
+    and one with a slash is anchored on the base directory.  Within a
+    segment, * and ? match as in fnmatch.  A segment ** matches any
+    number of segments.  A trailing slash only matches directories.  A
+    leading ! re-includes what earlier patterns matched.  A backslash
+    escapes the next character, as in \\! or \\#.  The patterns which do
+    not compile, such as [z-a], are left out and kept in invalid.
+    """
+
+    def __init__(self, patterns, base=''):
+        self.base = base and base + '/'
+        self.negated = False
+        for pattern in patterns:
+            if pattern.startswith('!'):
+                self.negated = True
+        self.rules = []
+        self.invalid = []
+        for pattern in patterns:
+            negated = pattern.startswith('!')
+            if negated:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            if '/' in pattern:
+                regex = translate_pattern(pattern.lstrip('/'))
+            else:
+                regex = '(?:.*/)?' + translate_pattern(pattern)
+            if regex.endswith('/.*') and not self.negated:
+                # Without exceptions, prune the directory itself
+                regex = regex[:-3] + '(?:/.*)?'
+            try:
+                rule = re.compile(regex + '$')
+            except re.error:
+                self.invalid.append(pattern)
+                continue
+            self.rules.append((rule, negated, dir_only))
+        self.dir_regex = self.combine(self.rules)
+        self.file_regex = self.combine([rule for rule in self.rules
+                                        if not rule[2]])
+
+    def combine(self, rules):
+        """
+        Return one regular expression which matches wherever one of the
+        rules matches, or None without rules.
+        """
+        if not rules:
+            return None
+        return re.compile('|'.join(['(?:%s)' % rule[0].pattern
+                                    for rule in rules]))
+
+    def match(self, path, is_dir=False):
+        """
+        Return True if the last pattern which matches a normalized path
+        excludes it, False if it re-includes it, and None if no pattern
+        matches.
+        """
+        if self.base:
+            if not path.startswith(self.base):
+                return None
+            path = path[len(self.base):]
+        if is_dir:
+            regex = self.dir_regex
+        else:
+            regex = self.file_regex
+        if regex is None or not regex.match(path):
+            return None
+        if not self.negated:
+            return True
+        for rule, negated, dir_only in reversed(self.rules):
+            if (is_dir or not dir_only) and rule.match(path):
+                return not negated
+
+    def excluded(self, path, is_dir=False, root=''):
+        """
+        Check if the patterns exclude a normalized path, or one of its
+        parent directories below the root directory.  The directories
+        above the root are outside the checked tree, and are never
+        matched: the patterns are anchored on the root.
+
+        >>> matcher = PathMatcher(['work', 'docs/build/', 'src/**/gen'])
+        >>> matcher.excluded('work/proj/x.py')
+        True
+        >>> matcher.excluded('/tmp/work/proj/x.py', root='/tmp/work/proj')
+        False
+        >>> matcher.excluded('/tmp/work', True, root='/tmp')
+        True
+        >>> matcher.excluded('docs/build', True)
+        True
+        >>> matcher.excluded('docs/build')
+        False
+        >>> matcher.excluded('lib/docs/build', True)
+        False
+        >>> matcher.excluded('src/gen/x.py'), matcher.excluded('src/a/b/gen')
+        (True, True)
+        >>> matcher = PathMatcher(['*.py', '!setup.py', 'setup.py/'])
+        >>> matcher.excluded('a/pep8.py'), matcher.excluded('a/setup.py')
+        (True, False)
+        >>> matcher.excluded('setup.py/x.txt')
+        True
+        >>> PathMatcher(['[z-a]', '*.py']).invalid
+        ['[z-a]']
+        """
+        if root and path.startswith(root.rstrip('/') + '/'):
+            path = path[len(root.rstrip('/')) + 1:]
+        segments = path.split('/')
+        for index in range(1, len(segments)):
+            if self.match('/'.join(segments[:index]), True):
+                return True
+        return bool(self.match(path, is_dir))
+
+
+def translate_pattern(pattern):
+    """
+    Translate a path pattern to a regular expression.
+
+    >>> translate_pattern('*.py')
+    '[^/]*\\\\.py'
+    >>> translate_pattern('vendor/**/tests')
+    'vendor/(?:.*/)?tests'
+    >>> translate_pattern('\\\\#notes\\\\*')
+    '\\\\#notes\\\\*'
+    """
+    parts = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith('**/', index):
+            parts.append('(?:.*/)?')
+            index += 2
+        elif pattern.startswith('**', index):
+            parts.append('.*')
+            index += 1
+        elif char == '\\' and index + 1 < len(pattern):
+            index += 1
+            parts.append(re.escape(pattern[index]))
+        elif char == '*':
+            parts.append('[^/]*')
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '[' and pattern.find(']', index + 2) > 0:
+            end = pattern.find(']', index + 2)
+            chars = pattern[index + 1:end].replace('\\', '\\\\')
+            if chars[0] == '!':
+                chars = '^' + chars[1:]
+            elif chars[0] == '^':
+                chars = '\\' + chars
+            parts.append('[%s]' % chars)
+            index = end
+        elif char.isalnum() or char in '/_-':
+            parts.append(char)
+        else:
+            parts.append('\\' + char)
+        index += 1
+    return ''.join(parts)
+
+
+def excluded_by(matchers, path, is_dir=False):
+    """
+    Check if the last of the matchers which matches a normalized path
+    excludes it.
+    """
+    excluded = False
+    for matcher in matchers:
+        matched = matcher.match(path, is_dir)
+        if matched is not None:
+            excluded = matched
+    return excluded
+
+
+def normalize_path(path):
+    """
+    Return a path with slashes as separators, without . segments.
+    """
+    return os.path.normpath(path).replace(os.sep, '/')
+
+
+def read_gitignore(filename, base):
+    """
+    Return a PathMatcher for the patterns of a .gitignore file in the
+    base directory.  An unreadable file has no patterns, and the invalid
+    lines are ignored, as git does.
+    """
+    patterns = []
+    try:
+        lines = readlines(filename)
+    except (IOError, OSError):
+        lines = []
+    for line in lines:
+        pattern = line.rstrip('\r\n')
+        while pattern.endswith(' ') and not pattern.endswith('\\ '):
+            pattern = pattern[:-1]  # An escaped trailing space is kept
+        if pattern and not pattern.startswith('#'):
+            patterns.append(pattern)
+    return PathMatcher(patterns, base)
+
+
+def list_directory(path):
+    """
+    Return the identity of a directory, and the sorted names of its
+    subdirectories and of its other entries.  Symbolic links to
+    directories are left out.  With os.scandir, the types of the entries
+    come with the listing, without a stat call for each.
+    """
+    status = os.stat(path)
+    dirs = []
+    files = []
+    if scandir is None:
+        for name in os.listdir(path):
+            child = os.path.join(path, name)
+            if not os.path.isdir(child):
+                files.append(name)
+            elif not os.path.islink(child):
+                dirs.append(name)
+    else:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif not entry.is_symlink() or not entry.is_dir():
+                files.append(entry.name)
+    dirs.sort()
+    files.sort()
+    return (status.st_dev, status.st_ino), dirs, files
+
+
+def _init_worker(worker_options):
+    """
+    Set up the style guide of a --jobs worker from the options of the
+    parent process.  Workers never print: the parent reports everything
+    they found.
+    """
+    global options, style_guide
+    worker_options.quiet = 2
+    worker_options.verbose = 0
+    style_guide = StyleGuide(worker_options)
+    options = style_guide.options
+
+
+def _check_batch(filenames):
+    """
+    Check a batch of files in a --jobs worker.  Return the results of
+    the files, and the profile of the batch with --profile-checks.
+    With --fail-fast, the batch stops at the first file with errors.
+    """
+    results = []
+    for filename in filenames:
+        results.append(style_guide.check_file_results(filename))
+        if style_guide.options.fail_fast and results[-1][3]:
+            break
+    if style_guide.profile is None:
+        return results, None
+    return results, style_guide.profile.take()
+
+
+def make_batches(filenames, jobs):
+    """
+    Group files into batches of similar size, largest files first, so
+    that a few huge modules don't stretch out the end of a parallel run.
+    """
+    sized = []
+    total = 0
+    for filename in filenames:
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            size = 0
+        sized.append((-size, filename))
+        total += size
+    sized.sort()
+    limit = total // (jobs * 8) + 1
+    batches = []
+    batch = []
+    batch_size = 0
+    for size, filename in sized:
+        batch.append(filename)
+        batch_size -= size
+        if batch_size >= limit:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def sha1_hex(text):
+    """
+    Return the SHA-1 hex digest of a string, encoded as UTF-8 if needed.
+    """
+    import hashlib
+    try:
+        return hashlib.sha1(text).hexdigest()
+    except TypeError:
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def git(*arguments):
+    """
+    Run a git command and return its standard output as text.
+    """
+    import subprocess
+    process = subprocess.Popen(('git',) + arguments, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise SystemExit('%s: git %s failed' %
+                         (os.path.basename(sys.argv[0]), ' '.join(arguments)))
+    if not isinstance(output, str):
+        output = output.decode('utf-8', 'replace')
+    return output
+
+
+class GitBlobReader(object):
+    """
+    Read blobs from the object database through a single
+    'git cat-file --batch' process, which is started on first use.
+    """
+
+    def __init__(self):
+        self.process = None
+
+    def read(self, blob):
+        """
+        Return the content of a blob as a list of lines.
+        """
+        if self.process is None:
+            import subprocess
+            self.process = subprocess.Popen(
+                ['git', 'cat-file', '--batch'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.process.stdin.write((blob + '\n').encode('ascii'))
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            raise SystemExit('%s: git cat-file failed on %s' %
+                             (os.path.basename(sys.argv[0]), blob))
+        data = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1)  # Newline after the content
+        return decode_lines(data)
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+
+
+class SocketStream(object):
+    """
+    File-like object which forwards the output of a --server request
+    to the client, one JSON message per write.  Any text goes through
+    JSON, so the stream declares UTF-8, as doctest and others expect
+    of sys.stdout.
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+
+    def write(self, text):
+        import json
+        self.wfile.write((json.dumps({self.name: text}) + '\n').encode())
+        self.wfile.flush()
+
+    def flush(self):
+        pass
+
+
+class MemoryCache(object):
+    """
+    The results of the files checked by a --server, by cache key.  The
+    keys are listed in the order of their last use, and the least
+    recently used entries are evicted first, as with an OrderedDict,
+    which Python 2.6 does not have.
+
+    >>> cache = MemoryCache()
+    >>> for key in 'abc':
+    ...     cache.store(key, key.upper(), 2)
+    >>> cache.get('a'), cache.get('b')
+    (None, 'B')
+    >>> cache.store('d', 'D', 2)
+    >>> cache.order
+    ['b', 'd']
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.order = []
+
+    def get(self, key):
+        """
+        Return the entry stored for key, marked as recently used, or
+        None.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.order.remove(key)
+            self.order.append(key)
+        return entry
+
+    def store(self, key, entry, size):
+        """
+        Store an entry for key, and evict the least recently used ones
+        beyond size entries.
+        """
+        if key in self.entries:
+            self.order.remove(key)
+        self.entries[key] = entry
+        self.order.append(key)
+        excess = len(self.order) - size
+        if excess > 0:
+            for evicted in self.order[:excess]:
+                del self.entries[evicted]
+            del self.order[:excess]
+
+
+def serve_request(connection):
+    """
+    Handle one request of a --server-client: run the checks with its
+    arguments, in its working directory, and send back the output and
+    the exit code.
+
+    The request is a JSON object on a single line, with the keys 'argv',
+    'cwd' and optionally 'sources', which maps file names found in argv
+    to source code to check in place of the files.
+    """
+    import json
+    import traceback
+    rfile = connection.makefile('rb')
+    wfile = connection.makefile('wb')
+    request = json.loads(rfile.readline().decode('utf-8'))
+    saved = sys.stdout, sys.stderr, os.getcwd()
+    sys.stdout = SocketStream(wfile, 'stdout')
+    sys.stderr = SocketStream(wfile, 'stderr')
+    status = 0
+    try:
+        try:
+            os.chdir(request['cwd'])
+            _main(request['argv'], request.get('sources'))
+        except SystemExit:
+            status = sys.exc_info()[1].code
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                sys.stderr.write(str(status) + '\n')
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    finally:
+        sys.stdout, sys.stderr = saved[:2]
+        os.chdir(saved[2])
+    wfile.write((json.dumps({'exit': status}) + '\n').encode())
+    wfile.close()
+    rfile.close()
+
+
+def serve(socket_path):
+    """
+    Serve check requests on a Unix socket, one at a time.  The server
+    keeps the check lists built for each set of --select and --ignore
+    options, and the results of the files it has checked, in memory.
+    """
+    import socket
+    global check_plans, memory_cache
+    check_plans = {}
+    memory_cache = MemoryCache()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)  # Left behind by a dead server
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_path)
+        server.listen(16)
+        while True:
+            connection = server.accept()[0]
+            try:
+                serve_request(connection)
+            finally:
+                connection.close()
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+def server_client(socket_path, arglist):
+    """
+    Forward the arguments to a --server, print its output and exit
+    with its exit code.
+    """
+    import json
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    request = {'argv': arglist, 'cwd': os.getcwd()}
+    client.sendall((json.dumps(request) + '\n').encode())
+    rfile = client.makefile('rb')
+    status = 1
+    for line in rfile:
+        response = json.loads(line.decode('utf-8'))
+        if 'stdout' in response:
+            sys.stdout.write(response['stdout'])
+        elif 'stderr' in response:
+            sys.stderr.write(response['stderr'])
+        else:
+            status = response['exit']
+    client.close()
+    sys.exit(status)
+
+
+##############################################################################
+# Functions of the default style guide, configured by process_options
+##############################################################################
+
+
+def find_checks(argument_name):
+    """
+    Find the checks registered with register_check where the first
+    argument name starts with argument_name, and which report some code
+    not ignored by the default style guide.
+    """
+    return style_guide.find_checks(argument_name)
+
+
+def input_file(filename, lines=None):
     """
     Run all checks on a Python source file.
     """
-    if options.verbose:
-        message('checking ' + filename)
-    errors = Checker(filename).check_all()
+    return style_guide.input_file(filename, lines)
 
 
 def input_dir(dirname, runner=None):
     """
     Check all Python source files in this directory and all subdirectories.
     """
-    dirname = dirname.rstrip('/')
-    if excluded(dirname):
-        return
-    if runner is None:
-        runner = input_file
-    for root, dirs, files in os.walk(dirname):
-        if options.verbose:
-            message('directory ' + root)
-        options.counters['directories'] += 1
-        dirs.sort()
-        for subdir in dirs:
-            if excluded(subdir):
-                dirs.remove(subdir)
-        files.sort()
-        for filename in files:
-            if filename_match(filename) and not excluded(filename):
-                options.counters['files'] += 1
-                runner(os.path.join(root, filename))
+    return style_guide.input_dir(dirname, runner)
 
 
 def excluded(filename):
     """
     Check if options.exclude contains a pattern that matches filename.
     """
-    basename = os.path.basename(filename)
-    for pattern in options.exclude:
-        if fnmatch(basename, pattern):
-            # print basename, 'excluded because it matches', pattern
-            return True
+    return style_guide.excluded(filename)
 
 
 def filename_match(filename):
@@ -1067,11 +4014,7 @@ def filename_match(filename):
     Check if options.filename contains a pattern that matches filename.
     If options.filename is unspecified, this always returns True.
     """
-    if not options.filename:
-        return True
-    for pattern in options.filename:
-        if fnmatch(filename, pattern):
-            return True
+    return style_guide.filename_match(filename)
 
 
 def ignore_code(code):
@@ -1079,19 +4022,11 @@ def ignore_code(code):
     Check if options.ignore contains a prefix of the error code.
     If options.select contains a prefix of the error code, do not ignore it.
     """
-    for select in options.select:
-        if code.startswith(select):
-            return False
-    for ignore in options.ignore:
-        if code.startswith(ignore):
-            return True
+    return style_guide.ignore_code(code)
 
 
 def reset_counters():
-    for key in list(options.counters.keys()):
-        if key not in BENCHMARK_KEYS:
-            del options.counters[key]
-    options.messages = {}
+    style_guide.report.reset()
 
 
 def get_error_statistics():
@@ -1113,41 +4048,24 @@ def get_statistics(prefix=''):
     prefix='W' matches all warnings
     prefix='E4' matches all errors that have to do with imports
     """
-    stats = []
-    keys = list(options.messages.keys())
-    keys.sort()
-    for key in keys:
-        if key.startswith(prefix):
-            stats.append('%-7s %s %s' %
-                         (options.counters[key], key, options.messages[key]))
-    return stats
+    return style_guide.report.get_statistics(prefix)
 
 
 def get_count(prefix=''):
     """Return the total count of errors and warnings."""
-    keys = list(options.messages.keys())
-    count = 0
-    for key in keys:
-        if key.startswith(prefix):
-            count += options.counters[key]
-    return count
+    return style_guide.report.get_count(prefix)
 
 
 def print_statistics(prefix=''):
     """Print overall statistics (number of errors and warnings)."""
-    for line in get_statistics(prefix):
-        print(line)
+    style_guide.report.print_statistics(prefix)
 
 
 def print_benchmark(elapsed):
     """
     Print benchmark numbers.
     """
-    print('%-7.2f %s' % (elapsed, 'seconds elapsed'))
-    for key in BENCHMARK_KEYS:
-        print('%-7d %s per second (%d total)' % (
-            options.counters[key] / elapsed, key,
-            options.counters[key]))
+    style_guide.report.print_benchmark(elapsed)
 
 
 def run_tests(filename):
@@ -1165,9 +4083,20 @@ def run_tests(filename):
     Examples:
 
      * Only E224 and W701 are expected:         #: E224 W701
+     * E231 is expected at least twice:         #: E231 E231
      * Following example is conform:            #: Okay
      * Don't check these lines:                 #:
+
+    With --first-only, a check reports one error per line, so a code
+    may be found fewer times than listed, and a code is not required
+    when another code of the same check is found.
     """
+    check_codes = {}
+    for name, check, argument_names in (options.physical_checks +
+                                        options.logical_checks +
+                                        options.tree_checks):
+        for code in check.codes:
+            check_codes[code] = check.codes
     lines = readlines(filename) + ['#:\n']
     line_offset = 0
     codes = ['Okay']
@@ -1183,10 +4112,21 @@ def run_tests(filename):
             codes = [c for c in codes if c != 'Okay']
             # Run the checker
             errors = Checker(filename, testcase).check_all(codes, line_offset)
-            # Check if the expected errors were found
-            for code in codes:
-                if not options.counters.get(code):
-                    errors += 1
+            # Check if the expected errors were found, as often as listed
+            for code in sorted(set(codes)):
+                found = options.counters.get(code, 0)
+                if options.first_only:
+                    for other in check_codes.get(code, ()):
+                        found = found or options.counters.get(other, 0)
+                    if found:
+                        continue
+                elif found >= codes.count(code):
+                    continue
+                errors += 1
+                if found:
+                    message('%s: error %s found %d times, expected %d' %
+                            (label, code, found, codes.count(code)))
+                else:
                     message('%s: error %s not found' % (label, code))
             if options.verbose and not errors:
                 message('%s: passed (%s)' % (label, ' '.join(codes)))
@@ -1206,7 +4146,8 @@ def selftest():
     """
     count_passed = 0
     count_failed = 0
-    checks = options.physical_checks + options.logical_checks
+    checks = (options.physical_checks + options.logical_checks +
+              options.tree_checks)
     for name, check, argument_names in checks:
         for line in check.__doc__.splitlines():
             line = line.lstrip()
@@ -1222,7 +4163,9 @@ def selftest():
             options.quiet = 2
             checker.check_all()
             error = None
-            if code == 'Okay':
+            if code != 'Okay' and code not in check.codes:
+                error = "%s is not registered by %s" % (code, name)
+            elif code == 'Okay':
                 if len(options.counters) > len(BENCHMARK_KEYS):
                     codes = [key for key in options.counters.keys()
                              if key not in BENCHMARK_KEYS]
@@ -1250,11 +4193,31 @@ def selftest():
             print("Test passed.")
 
 
-def process_options(arglist=None):
+def lexer_test(paths):
+    """
+    Compare the tokens of FastLexer with those of tokenize on the files
+    found in paths, and exit with status 1 on any difference.
+    """
+    failed = []
+
+    def compare(filename):
+        difference = compare_lexers(readlines(filename))
+        if difference:
+            failed.append(filename)
+            message('%s: %s' % (filename, difference))
+    style_guide.check_files(paths, compare)
+    if options.verbose:
+        print("%d files compared, %d differ." %
+              (style_guide.report.counters['files'], len(failed)))
+    if failed:
+        sys.exit(1)
+
+
+def get_parser():
     """
-    Process options passed either via arglist or via command line args.
+    Create the parser of the command line options.
     """
-    global options, args
+    from optparse import OptionParser
     parser = OptionParser(version=__version__,
                           usage="%prog [options] input ...")
     parser.add_option('-v', '--verbose', default=0, action='count',
@@ -1267,6 +4230,9 @@ def process_options(arglist=None):
                       help="exclude files or directories which match these "
                         "comma separated patterns (default: %s)" %
                         DEFAULT_EXCLUDE)
+    parser.add_option('--gitignore', action='store_true',
+                      help="also exclude what the .gitignore files of the "
+                        "checked directories ignore")
     parser.add_option('--filename', metavar='patterns', default='*.py',
                       help="when parsing directories, only check filenames "
                         "matching these comma separated patterns (default: "
@@ -1275,6 +4241,9 @@ def process_options(arglist=None):
                       help="select errors and warnings (e.g. E,W6)")
     parser.add_option('--ignore', metavar='errors', default='',
                       help="skip errors and warnings (e.g. E4,W)")
+    parser.add_option('--first-only', action='store_true',
+                      help="report only the first error of each check on "
+                        "each line")
     parser.add_option('--show-source', action='store_true',
                       help="show source code for each error")
     parser.add_option('--show-pep8', action='store_true',
@@ -1285,71 +4254,142 @@ def process_options(arglist=None):
                       help="print total number of errors and warnings "
                         "to standard error and set exit code to 1 if "
                         "total is not null")
+    parser.add_option('--max-errors-per-file', metavar='n', type='int',
+                      default=0,
+                      help="stop checking a file after n errors")
+    parser.add_option('--fail-fast', action='store_true',
+                      help="stop at the first error, and set exit code "
+                        "to 1")
+    parser.add_option('-j', '--jobs', metavar='n', type='int', default=1,
+                      help="check files in n parallel processes "
+                        "(default: 1)")
+    parser.add_option('--cache-dir', metavar='dir',
+                      help="cache the results of unchanged files in dir")
+    parser.add_option('--cache-size', metavar='n', type='int', default=20000,
+                      help="keep at most n files in the cache "
+                        "(default: 20000)")
+    parser.add_option('--git-staged', action='store_true',
+                      help="check the Python files staged in git")
+    parser.add_option('--git-changed', metavar='revisions',
+                      help="check the Python files changed between "
+                        "git revisions (e.g. HEAD~1..HEAD)")
+    parser.add_option('--server', metavar='socket',
+                      help="serve check requests on this Unix socket")
+    parser.add_option('--server-client', metavar='socket',
+                      help="forward the check to the server on this socket")
+    parser.add_option('--profile-checks', action='store_true',
+                      help="print the time spent in each check")
+    parser.add_option('--profile-json', metavar='file',
+                      help="write the time spent in each check to a "
+                        "JSON file")
+    parser.add_option('--stream', action='store_true',
+                      help="read each file line by line, and keep only "
+                        "the last lines in memory")
+    parser.add_option('--compact-tokens', action='store_true',
+                      help="keep the tokens of each logical line in "
+                        "compact arrays")
+    parser.add_option('--fused-scan', action='store_true',
+                      help="scan each logical line once for the regular "
+                        "expression checks")
+    parser.add_option('--fast-lexer', action='store_true',
+                      help="tokenize the simple statements without the "
+                        "tokenize module")
     parser.add_option('--benchmark', action='store_true',
                       help="measure processing speed")
     parser.add_option('--testsuite', metavar='dir',
                       help="run regression tests from dir")
     parser.add_option('--doctest', action='store_true',
                       help="run doctest on myself")
+    parser.add_option('--lexer-test', action='store_true',
+                      help="compare the tokens of --fast-lexer with those "
+                        "of tokenize on the input files")
+    return parser
+
+
+def process_options(arglist=None):
+    """
+    Process options passed either via arglist or via command line args,
+    and configure the default style guide with them.
+    """
+    global options, args, style_guide
+    parser = get_parser()
     options, args = parser.parse_args(arglist)
     if options.testsuite:
         args.append(options.testsuite)
-    if not args and not options.doctest:
+    if options.git_staged or options.git_changed:
+        if options.git_staged and options.git_changed:
+            parser.error('--git-staged and --git-changed are exclusive')
+    elif not args and not options.doctest and not options.server:
         parser.error('input not specified')
+    if options.quiet and not (options.statistics or options.count or
+                              options.benchmark or options.testsuite or
+                              options.cache_dir or options.profile_checks or
+                              options.profile_json):
+        # The first error decides the file name or the exit status
+        if options.quiet > 1:
+            options.fail_fast = True
+        elif not options.max_errors_per_file:
+            options.max_errors_per_file = 1
     options.prog = os.path.basename(sys.argv[0])
-    options.exclude = options.exclude.split(',')
-    for index in range(len(options.exclude)):
-        options.exclude[index] = options.exclude[index].rstrip('/')
-    if options.filename:
-        options.filename = options.filename.split(',')
-    if options.select:
-        options.select = options.select.split(',')
-    else:
-        options.select = []
-    if options.ignore:
-        options.ignore = options.ignore.split(',')
-    elif options.select:
-        # Ignore all checks which are not explicitly selected
-        options.ignore = ['']
-    elif options.testsuite or options.doctest:
-        # For doctest and testsuite, all checks are required
-        options.ignore = []
-    else:
-        # The default choice: ignore controversial checks
-        options.ignore = DEFAULT_IGNORE.split(',')
-    options.physical_checks = find_checks('physical_line')
-    options.logical_checks = find_checks('logical_line')
-    options.counters = dict.fromkeys(BENCHMARK_KEYS, 0)
-    options.messages = {}
+    style_guide = StyleGuide(options)
+    options = style_guide.options
+    for option, matcher in (('--exclude', style_guide.exclude_matcher),
+                            ('--filename', style_guide.filename_matcher)):
+        if matcher.invalid:
+            parser.error('invalid %s pattern: %s' %
+                         (option, matcher.invalid[0]))
     return options, args
 
 
-def _main():
+def _main(arglist=None, sources=None):
     """
     Parse options and run checks on Python source.
+
+    The sources argument maps file names to source code to check in
+    place of the files.
     """
-    options, args = process_options()
+    if arglist is None:
+        arglist = sys.argv[1:]
+    for index, argument in enumerate(arglist):
+        # The client does not need the checks: skip process_options
+        if argument.startswith('--server-client='):
+            server_client(argument.split('=', 1)[1],
+                          arglist[:index] + arglist[index + 1:])
+        elif argument == '--server-client' and index + 1 < len(arglist):
+            server_client(arglist[index + 1],
+                          arglist[:index] + arglist[index + 2:])
+    options, args = process_options(arglist)
+    if options.server:
+        serve(options.server)
     if options.doctest:
         import doctest
         doctest.testmod(verbose=options.verbose)
         selftest()
+    if options.lexer_test:
+        lexer_test(args)
+        args = []
     if options.testsuite:
         runner = run_tests
     else:
-        runner = input_file
+        runner = None
     start_time = time.time()
-    for path in args:
-        if os.path.isdir(path):
-            input_dir(path, runner=runner)
-        elif not excluded(path):
-            options.counters['files'] += 1
-            runner(path)
+    if options.git_staged or options.git_changed:
+        try:
+            style_guide.input_git(options.git_changed, args)
+        except StopChecking:
+            pass  # --fail-fast found an error: the exit status is decided
+        args = []
+    report = style_guide.check_files(args, runner, sources)
     elapsed = time.time() - start_time
     if options.statistics:
-        print_statistics()
+        report.print_statistics()
     if options.benchmark:
-        print_benchmark(elapsed)
-    count = get_count()
+        report.print_benchmark(elapsed)
+    if options.profile_checks:
+        style_guide.profile.print_table()
+    if options.profile_json:
+        style_guide.profile.write_json(options.profile_json)
+    count = report.get_count()
     if count:
         if options.count:
             sys.stderr.write(str(count) + '\n')
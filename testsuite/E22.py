@@ -13,6 +13,11 @@ long_variable = 3
 x = f(x)          + 1
 y = long_variable + 2
 z = x[0]          + 3
+#: E221 E222
+a = 4  +  5
+#: E221 E221
+a = 4  + 5
+b = c  + d
 #: Okay
 x = 1
 y = 2
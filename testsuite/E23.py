@@ -2,6 +2,10 @@
 a = (1,2)
 #: E231
 a[b1,:]
+#: E231 E231
+foo(bar,baz,qux)
+#: E231 E231 E231
+a = {'a':1,'b':2}
 #: Okay
 a = (4,)
 b = (5, )
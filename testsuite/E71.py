@@ -0,0 +1,33 @@
+#: E711
+if res == None:
+    pass
+#: E711
+if res != None:
+    pass
+#: E711
+if None == res:
+    pass
+#: E712
+if res == True:
+    pass
+#: E712
+if res != False:
+    pass
+#: E711
+x = (res ==
+     None)
+#: E711 E712
+if (res == None or
+        other == False):
+    pass
+#: E711
+if res == (None):
+    pass
+#: E711
+x = (res ==  # comment
+     None)
+#: Okay
+if res is None or other is not False:
+    pass
+if x == none or y == 'None':
+    pass
@@ -0,0 +1,19 @@
+#: E721
+if type(res) == type(42):
+    pass
+#: E721
+if type(res) != type(""):
+    pass
+#: E721
+if int != type(res):
+    pass
+#: E721
+if type(f(g(res))) == int:
+    pass
+#: Okay
+if isinstance(res, int):
+    pass
+if type(res) is type(42):
+    pass
+if type(a, b, c) == d:
+    pass